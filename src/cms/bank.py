@@ -0,0 +1,164 @@
+"""
+Bank of count-min sketches of many tenants (e.g. customers or partitions),
+stored as one counter array.
+"""
+import copy
+import numpy as np
+
+from collections import Counter
+
+from cms.cms import CMS
+from cms.counters import DictCounter
+from cms.utils import sum_dict
+
+
+class CMSBank:
+    """
+    T count-min sketches of size (d, w) with the same hash functions, stored
+    as a (T, d, w) array of int64 counters.
+
+    Events are (tenant, key) pairs, with tenants numbered 0, ..., T-1. A
+    chunk of events is hashed once for all tenants and, for non-conservative
+    sketches, added to the counters with a single scatter-add over the flat
+    indices (tenant * d + row) * w + column. Conservative updates depend on
+    the order of the updates of each sketch, so they are applied tenant by
+    tenant, in stream order within each tenant. Queries take batches of
+    (tenant, key) pairs and read the counters with a single gather.
+
+    The exact counts of each tenant are kept in a separate counter, if
+    track_exact=True. sketch(t) returns the sketch of tenant t as a CMS, for
+    use with the calibration code of cms.conformal.
+    """
+    def __init__(self, n_tenants, d, w, seed=2021, conservative=False, engine="numpy",
+                 hash_family="mmh3", track_exact=True, exact_counter=DictCounter):
+        assert n_tenants > 0
+        self.n_tenants = n_tenants
+        self.d = d
+        self.w = w
+        self.seed = seed
+        self.conservative = conservative
+        self.engine = engine
+        self.hash_family = hash_family
+        self.track_exact = track_exact
+        self.exact_counter = exact_counter
+        # Empty sketch providing the hash functions shared by all tenants
+        self._template = CMS(d, w, seed=seed, conservative=conservative, engine=engine,
+                             hash_family=hash_family, dtype="int64", track_exact=False)
+        self._rows = np.arange(d)
+        self.reset()
+
+    def reset(self):
+        self.count = np.zeros((self.n_tenants, self.d, self.w), dtype=np.int64)
+        self.true_counts = [self.exact_counter() for _ in range(self.n_tenants)]
+
+    def __len__(self):
+        return self.n_tenants
+
+    def _check_tenants(self, tenants, n):
+        tenants = np.asarray(tenants, dtype=np.int64).reshape(-1)
+        assert len(tenants) == n
+        if n > 0:
+            assert (tenants.min() >= 0) and (tenants.max() < self.n_tenants), "Tenants must lie in [0, n_tenants)"
+        return tenants
+
+    def update_many(self, tenants, keys, counts=None):
+        """
+        Adds a chunk of events: key keys[i] (with multiplicity counts[i],
+        default 1) in the stream of tenant tenants[i]
+        """
+        if not isinstance(keys, np.ndarray):
+            keys = list(keys)
+        tenants = self._check_tenants(tenants, len(keys))
+        if counts is not None:
+            counts = np.asarray(counts, dtype=np.int64)
+            assert len(counts) == len(keys)
+        if len(keys) == 0:
+            return
+
+        if self.track_exact:
+            if counts is None:
+                pairs = Counter(zip(tenants.tolist(), keys))
+            else:
+                pairs = Counter()
+                for t, x, c in zip(tenants.tolist(), keys, counts.tolist()):
+                    pairs[(t, x)] += c
+            for (t, x), c in pairs.items():
+                self.true_counts[t].add(x, c)
+
+        columns = self._template._hash_keys(keys)
+        if self.conservative:
+            self._update_conservative(tenants, columns, counts)
+            return
+        cells = ((tenants[:, None] * self.d + self._rows) * self.w + columns).reshape(-1)
+        increments = 1 if counts is None else np.repeat(counts, self.d)
+        np.add.at(self.count.reshape(-1), cells, increments)
+
+    def _update_conservative(self, tenants, columns, counts=None):
+        if counts is None:
+            counts = np.ones(len(columns), dtype=np.int64)
+        # A stable sort keeps the stream order of the updates of each tenant
+        order = np.argsort(tenants, kind="stable")
+        groups, starts = np.unique(tenants[order], return_index=True)
+        for t, chunk in zip(groups, np.split(order, starts[1:])):
+            self._template._conservative_update(self.count[t], columns[chunk], counts[chunk])
+
+    def update_count(self, tenant, x, n=1):
+        self.update_many([tenant], [x], [n])
+
+    def estimate_many(self, tenants, keys):
+        """
+        Returns the (n,) array of count estimates of n (tenant, key) pairs
+        """
+        if not isinstance(keys, np.ndarray):
+            keys = list(keys)
+        tenants = self._check_tenants(tenants, len(keys))
+        if len(keys) == 0:
+            return np.zeros(0, dtype=int)
+        columns = self._template._hash_keys(keys)
+        return np.min(self.count[tenants[:, None], self._rows, columns], axis=1).astype(int)
+
+    def estimate_count(self, tenant, x):
+        return self.estimate_many([tenant], [x])[0]
+
+    def true_many(self, tenants, keys):
+        """
+        Returns the exact counts of n (tenant, key) pairs
+        """
+        if not self.track_exact:
+            raise ValueError("Exact counts need track_exact=True.")
+        keys = list(keys)
+        tenants = self._check_tenants(tenants, len(keys))
+        counts = np.zeros(len(keys), dtype=np.int64)
+        for t in np.unique(tenants):
+            idx = np.where(tenants == t)[0]
+            counts[idx] = self.true_counts[t].lookup([keys[i] for i in idx])
+        return counts
+
+    def sketch(self, tenant):
+        """
+        Returns the sketch of a tenant as a CMS, identical to a sketch with
+        the same parameters that ingested the events of this tenant alone.
+        The CMS holds copies of the counters and exact counts, so later
+        updates of the bank do not change it.
+        """
+        cms = CMS(self.d, self.w, seed=self.seed, conservative=self.conservative, engine=self.engine,
+                  hash_family=self.hash_family, dtype="int64", track_exact=self.track_exact,
+                  exact_counter=self.exact_counter)
+        cms.count = self.count[tenant].copy()
+        if self.track_exact:
+            cms.true_count = copy.deepcopy(self.true_counts[tenant])
+        return cms
+
+    def __getitem__(self, tenant):
+        return self.sketch(tenant)
+
+    def merge(self, other):
+        """
+        Adds the counters of another bank built with the same hash functions
+        """
+        if (self.n_tenants, self.d, self.w, self.seed, self.hash_family) != \
+           (other.n_tenants, other.d, other.w, other.seed, other.hash_family):
+            raise ValueError("Cannot merge banks with different T, d, w, seed or hash family.")
+        self.count += other.count
+        self.true_counts = [sum_dict(mine, theirs) for mine, theirs in zip(self.true_counts, other.true_counts)]
+        return self
@@ -7,7 +7,7 @@ from collections import defaultdict, OrderedDict, Counter
 from scipy.stats.mstats import mquantiles
 from scipy.stats import mannwhitneyu
 
-from cms.cms import BayesianCMS, BayesianDP
+from cms.cms import BayesianCMS, BayesianDP, snapshot_stream, exact_counts
 from cms.cqr import QR, QRScores
 from cms.conformal import ClassicalScores, BayesianScores
 from cms.utils import sum_dict, dictToList, listToDict
@@ -48,9 +48,12 @@ class BootstrapCMS:
         sys.stdout.flush()
 
         # Process stream
+        snapshot = snapshot_stream(self.cms, self.stream)
         for i in tqdm(range(n), disable=False):
             x = self.stream.sample()
             self.cms.update_count(x)
+        # The noise distribution reads the counters directly
+        self.cms.flush()
 
         # CMS parameters
         r,w = self.cms.count.shape
@@ -64,7 +67,7 @@ class BootstrapCMS:
                 J = np.random.choice(w, r)
                 if not common_member(I,J):
                     c_J = np.array([self.cms.count[k, J[k]] for k in range(r)])
-                    noise[i] = np.min(c_J)
+                    noise[i] = self.cms.rescale(np.min(c_J))
                     i = i +1
             return noise
 
@@ -89,7 +92,6 @@ class BootstrapCMS:
         noise = None
         for i in tqdm(range(n_test), disable=False):
             x = self.stream.sample()
-            y = self.cms.true_count[x]
 
             if noise is None:
                 noise = estimate_noise_dist(x)
@@ -112,10 +114,14 @@ class BootstrapCMS:
             est_median = np.maximum(0, upper_max - delta_median)
 
             results.append({'method':'Bootstrap',
-                            'x':x, 'count':y, 'upper': upper, 'lower':lower,
+                            'x':x, 'count':None, 'upper': upper, 'lower':lower,
                             'mean':est_median, 'median':est_median, 'mode':est_median,
                             'seen':0})
 
+        y_test = exact_counts(self.cms, [r['x'] for r in results], snapshot, n)
+        for r, y in zip(results, y_test):
+            r['count'] = y
+
         results = pd.DataFrame(results)
         results = results.sort_values(by=['count'], ascending=False)
         return results
@@ -8,10 +8,21 @@ import copy
 from methodtools import lru_cache
 from tqdm import tqdm
 import sys
+import os
 import mmh3
 import multiprocessing
-
-from collections import defaultdict, OrderedDict
+import itertools
+import queue
+import warnings
+import weakref
+import json
+import pickle
+import struct
+import tempfile
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ThreadPoolExecutor
+
+from collections import defaultdict, OrderedDict, Counter
 from scipy.stats.mstats import mquantiles
 from scipy.special import comb
 from scipy.special import loggamma, softmax
@@ -19,10 +30,15 @@ from scipy import optimize
 from scipy import stats
 from sklearn import mixture
 
-from cms.data import WordStream, StreamFile, DP, SP
-from cms.utils import sort_dict
+from cms.data import WordStream, StreamFile, DNAStream, DP, SP
+from cms.utils import sort_dict, sum_dict, count_keys
 
 from cms.chr import HistogramAccumulator
+from cms import kernels
+from cms.hashing import MultiplyShiftHash, encode_keys
+from cms.topk import TopK
+from cms.counters import DictCounter
+from cms.stats import LoadStats
 
 from julia.api import Julia
 jl = Julia(compiled_modules=False)
@@ -89,6 +105,17 @@ def compute_mode(x, bins=20):
     return bins[max_bin:max_bin+2].mean()
 
 
+# On-disk sketch format: magic, version, header length, JSON header, padding
+# to a 64-byte boundary, the raw counter matrix (C order) and optionally the
+# pickled exact counts.
+_FILE_MAGIC = b"CMSKETCH"
+_FILE_VERSION = 1
+_FILE_ALIGN = 64
+
+# Supported counter types, and promotion order of dtype="auto"
+_COUNT_DTYPES = ["uint16", "uint32", "int32", "int64"]
+_AUTO_DTYPES = ["uint16", "uint32", "int64"]
+
 def _choice(probs):
     x = np.random.rand()
     cum = 0
@@ -98,19 +125,571 @@ def _choice(probs):
             break
     return i
 
+def add_exact_counts(counter, keys, counts=None):
+    """
+    Adds a chunk of keys, with multiplicities counts (default 1), to an
+    exact counter
+    """
+    if counts is None:
+        counter_chunk = Counter(keys)
+        counter.add_many(counter_chunk.keys(), counter_chunk.values())
+    else:
+        counter.add_many(keys, counts)
+
 class CMS:
-    def __init__(self, d, w, seed=2021, conservative=False):
+    def __init__(self, d, w, seed=2021, conservative=False, engine="numpy", cache_size=0,
+                 hash_family="mmh3", dtype="int32", top_k=None, track_exact=True,
+                 exact_counter=DictCounter, instrument=False, buffer_size=0, buffer_conservative=False,
+                 n_threads=1, sample_rate=1.0):
+        assert engine in ["numpy", "numba"]
+        assert dtype in ["auto"] + _COUNT_DTYPES
+        assert hash_family in ["mmh3", "multiply-shift"]
+        assert n_threads >= 1
+        assert (sample_rate > 0) and (sample_rate <= 1)
+        if engine == "numba" and kernels.numba is None:
+            warnings.warn("numba is not installed, conservative updates will run in pure Python.")
+        if buffer_size and conservative and not buffer_conservative:
+            raise ValueError("Buffering changes the order of conservative updates: set buffer_conservative=True to allow it.")
         self.d = d # Number of hash functions
         self.w = w # Width
         self.seed = seed
+        self.hash_family = hash_family
+        if self.hash_family == "multiply-shift":
+            self._hasher = MultiplyShiftHash(self.d, self.seed)
         self.hash_functions = [self.__generate_hash_function(self.seed+i) for i in range(self.d)]
-        self.count = np.zeros((self.d, self.w), dtype='int32')
-        self.true_count = defaultdict(lambda: 0)
+        # With dtype="auto" the counters start compact and are promoted when needed
+        self.dtype = dtype
+        self.count = np.zeros((self.d, self.w), dtype=self._initial_dtype())
+        # Exact counts: exact_counter is called to create an empty counter
+        # (e.g. cms.counters.SpillCounter to keep them on disk)
+        self.exact_counter = exact_counter
+        self.true_count = exact_counter()
         self.conservative = conservative
+        self.engine = engine
+        # Sketch-only mode: skip the exact counts of every key
+        self.track_exact = track_exact
+        self._rows = np.arange(self.d)
+        # Bounded LRU cache: key -> bucket indices (disabled if cache_size=0)
+        self.cache_size = cache_size
+        self.clear_cache()
+        # Optional tracker of the top_k keys by estimated count
+        self.top_k = top_k
+        self.heavy_hitters = TopK(top_k) if top_k else None
+        # Shared memory block holding the counter matrix, if any
+        self._shm = None
+        # Whether the buffers are shared with frozen views (copy-on-write)
+        self._borrowed = False
+        # Load statistics kept up to date during ingestion (see stats)
+        self.instrument = instrument
+        self._load = LoadStats(self.count) if instrument else None
+        # Micro-batch of buffered updates, applied by flush (disabled if buffer_size=0)
+        self.buffer_size = buffer_size
+        self.buffer_conservative = buffer_conservative
+        self._buffer = Counter()
+        self._buffered = 0
+        # Threads updating the rows of bulk non-conservative updates in parallel
+        self.n_threads = n_threads
+        self._pool = None
+        # Load shedding: each occurrence is added to the counters with
+        # probability sample_rate, and the estimates are rescaled (see rescale).
+        # The exact counts still see every occurrence, so the full speed-up
+        # needs track_exact=False
+        self.sample_rate = sample_rate
+        self._rng = np.random.default_rng(seed)
 
     def reset(self):
-        self.count = np.zeros((self.d, self.w), dtype='int32')
-        self.true_count = defaultdict(lambda: 0)
+        if self._shm is not None:
+            # Keep the matrix in the shared block, other processes see it
+            self.count[:] = 0
+        else:
+            self.count = np.zeros((self.d, self.w), dtype=self._initial_dtype())
+        self.true_count = self.exact_counter()
+        self.clear_cache()
+        if self.top_k:
+            self.heavy_hitters = TopK(self.top_k)
+        self._borrowed = False
+        self._load = LoadStats(self.count) if self.instrument else None
+        self._buffer = Counter()
+        self._buffered = 0
+
+    def _initial_dtype(self):
+        return _AUTO_DTYPES[0] if self.dtype == "auto" else self.dtype
+
+    def clear_cache(self):
+        self._hash_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _get_state(self, shared):
+        state = self.__dict__.copy()
+        # The hash lambdas cannot be pickled: they are rebuilt from the seed
+        del state["hash_functions"]
+        for key in ["_shm", "_shm_finalizer"]:
+            state.pop(key, None)
+        state["_pool"] = None
+        state["_borrowed"] = False
+        state["_shm_name"] = None
+        if self._shm is not None:
+            if shared:
+                # Send the name of the block, the receiver attaches to it
+                state["_shm_name"] = self._shm.name
+                state["count"] = (self.count.shape, self.count.dtype.str)
+            else:
+                state["count"] = np.array(self.count)
+        return state
+
+    def __getstate__(self):
+        return self._get_state(shared=True)
+
+    def __setstate__(self, state):
+        shm_name = state.pop("_shm_name", None)
+        self.__dict__.update(state)
+        self._shm = None
+        self.hash_functions = [self.__generate_hash_function(self.seed+i) for i in range(self.d)]
+        if shm_name is not None:
+            shape, dtype = self.count
+            self._attach_shared_memory(shm_name, shape, dtype)
+
+    def __deepcopy__(self, memo):
+        # Deep copies get a private counter matrix, even if this one is shared
+        other = self.__class__.__new__(self.__class__)
+        other.__setstate__(copy.deepcopy(self._get_state(shared=False), memo))
+        return other
+
+    def freeze(self):
+        """
+        Returns a read-only snapshot of the sketch that shares its buffers.
+
+        The view shares the counter matrix (as a non-writeable array), the
+        exact counts and the heavy-hitters tracker with this sketch, so it
+        costs almost no memory. Buffers are copied on write: the first update
+        of either this sketch or the view gives it private copies, so the
+        view always sees the counters as they were when it was frozen.
+        A matrix in shared memory is updated in place by other processes, so
+        in that case the view gets a private copy of the matrix.
+        """
+        self.flush()
+        view = self.__class__.__new__(self.__class__)
+        view.__dict__.update(self.__dict__)
+        view._shm = None
+        view.__dict__.pop("_shm_finalizer", None)
+        self._freeze_buffers(view)
+        view._buffer = Counter()
+        view.clear_cache()
+        view._load = copy.deepcopy(self._load)
+        view._rng = self._spawn_rng()
+        view._borrowed = True
+        self._borrowed = True
+        return view
+
+    def fold(self, new_w):
+        """
+        Returns the sketch of width new_w of the same stream, without
+        re-ingesting it. new_w must divide w.
+
+        Both hash families reduce a hash value h to a bucket in a way that
+        nests across widths: with mmh3, h % new_w = (h % w) % new_w; with
+        multiply-shift, (h * new_w) >> 32 = ((h * w) >> 32) // (w / new_w).
+        Each bucket of the narrow sketch is therefore the sum of w / new_w
+        buckets of the wide one, and the result is exactly the CMS with the
+        same seed and width new_w, so one ingestion at the largest width
+        yields the sketches of all its divisors. The exact counts are shared
+        with this sketch (copy-on-write, as in freeze).
+
+        Conservative updates do not commute with this sum, so conservative
+        sketches cannot be folded.
+        """
+        if self.conservative:
+            raise ValueError("Conservative sketches cannot be folded.")
+        if (new_w <= 0) or (self.w % new_w != 0):
+            raise ValueError("The new width must divide w = {:d}.".format(self.w))
+        self.flush()
+        ratio = self.w // new_w
+        count = self._matrix().astype(np.int64)
+        if self.hash_family == "multiply-shift":
+            count = count.reshape(self.d, new_w, ratio).sum(axis=2)
+        else:
+            count = count.reshape(self.d, ratio, new_w).sum(axis=1)
+
+        folded = CMS.__new__(CMS)
+        folded.__dict__.update(self.__dict__)
+        for key in ["_shm_finalizer", "_dense", "_index", "_values"]:
+            folded.__dict__.pop(key, None)
+        folded._shm = None
+        folded.w = new_w
+        folded.hash_functions = [folded.__generate_hash_function(folded.seed+i) for i in range(folded.d)]
+        folded.count = np.zeros((self.d, new_w), dtype=self._count_dtype())
+        folded._write_count(count)
+        folded.clear_cache()
+        folded._buffer = Counter()
+        folded._buffered = 0
+        folded._rng = self._spawn_rng()
+        if folded.instrument:
+            folded._load = LoadStats(folded.count)
+        if self.heavy_hitters is not None:
+            candidates = list(self.heavy_hitters.estimates)
+            folded.heavy_hitters = TopK(self.top_k)
+            folded._offer_heavy_hitters(candidates, folded.estimate_many(candidates))
+        folded._borrowed = True
+        self._borrowed = True
+        return folded
+
+    def _detach(self):
+        """
+        Gives this sketch private copies of the buffers shared with frozen
+        views, before they are modified
+        """
+        if not self._borrowed:
+            return
+        self._copy_buffers()
+        self.true_count = copy.deepcopy(self.true_count)
+        self.heavy_hitters = copy.deepcopy(self.heavy_hitters)
+        self._borrowed = False
+
+    def flush(self):
+        """
+        Applies the buffered updates, one weighted update per distinct key.
+
+        With buffer_size > 0, update_count only records the key in a buffer
+        of multiplicities, which is applied once buffer_size updates have
+        been buffered. On skewed streams this hashes and writes each distinct
+        key once per micro-batch instead of once per occurrence. Queries,
+        merges, freezing and saving flush the buffer first; code that reads
+        self.count directly should call flush itself.
+
+        For conservative sketches a weighted update of a key is not
+        equivalent to separate updates interleaved with other keys, so the
+        counters may differ from those of unbuffered ingestion (they remain
+        upper bounds of the true counts); this requires buffer_conservative=True.
+        """
+        if len(self._buffer) == 0:
+            return
+        keys = list(self._buffer.keys())
+        counts = list(self._buffer.values())
+        self._buffer = Counter()
+        self._buffered = 0
+        self.update_many(keys, counts)
+
+    def _rescan(self):
+        """
+        Recomputes the load statistics after the counters were replaced
+        """
+        if self._load is None:
+            return
+        load = LoadStats(self._matrix())
+        load.updates, load.queries = self._load.updates, self._load.queries
+        load.first_update, load.last_update = self._load.first_update, self._load.last_update
+        self._load = load
+
+    def stats(self):
+        """
+        Returns load statistics of the sketch, as a dictionary with:
+          mass, max:          per-row total count and largest counter
+          empty_fraction:     per-row fraction of empty buckets
+          quantiles:          per-row quantiles (0.5, 0.9, 0.99) of the counters,
+                              rounded up to 2^k - 1
+          collision_rate:     estimated probability that an unseen key has a
+                              nonzero estimate (product of the row occupancies)
+          updates, queries:   number of keys added and estimated
+          elapsed:            seconds between the first and the last update
+          updates_per_second: ingestion throughput over that interval
+
+        With instrument=True the statistics are maintained during updates,
+        so this call costs O(d) and can be polled during ingestion. Otherwise,
+        or if the matrix lives in shared memory (where other processes update
+        it), the counter matrix is scanned and the update and query counters
+        are not available (None).
+        """
+        self.flush()
+        load = self._load
+        if load is None or self._shm is not None:
+            scan = LoadStats(self._matrix())
+            if load is not None:
+                scan.updates, scan.queries = load.updates, load.queries
+                scan.first_update, scan.last_update = load.first_update, load.last_update
+            load = scan
+        stats = {"d": self.d, "w": self.w, "dtype": str(self._count_dtype())}
+        stats.update(load.summary())
+        if self._load is None:
+            for key in ["updates", "queries", "elapsed", "updates_per_second"]:
+                stats[key] = None
+        return stats
+
+    # Storage of the counters. SparseCMS overrides these primitives, the rest
+    # of the class only accesses the counter matrix through them or through
+    # self.count.
+
+    def _matrix(self):
+        """
+        Returns the counters as a dense (d, w) array, without changing storage
+        """
+        return self.count
+
+    def _count_dtype(self):
+        return self.count.dtype
+
+    def _promote(self, dtype):
+        self.count = self.count.astype(dtype)
+
+    def _get_cells(self, columns):
+        return self.count[self._rows, columns]
+
+    def _set_cells(self, columns, values):
+        self.count[self._rows, columns] = values
+
+    def _read(self, cells):
+        return self.count.flat[cells]
+
+    def _write(self, cells, values):
+        """
+        Sets the counters of the sorted, distinct flat indices cells
+        """
+        self.count.flat[cells] = values
+
+    def _add_cells(self, cells, increments):
+        """
+        Adds int64 increments to the counters of the flat indices cells,
+        which may contain duplicates
+        """
+        cells, inverse = np.unique(cells, return_inverse=True)
+        old = self._read(cells).astype(np.int64)
+        new = old.copy()
+        np.add.at(new, inverse.reshape(-1), increments)
+        self._reserve(int(new.max()))
+        if self._load is not None:
+            self._load.record(cells // self.w, old, new)
+        self._write(cells, new)
+
+    def _nonzero_cells(self):
+        """
+        Returns the flat indices (row * w + column) and values of the
+        non-empty buckets
+        """
+        cells = np.flatnonzero(self.count)
+        return cells, self.count.flat[cells]
+
+    def _row_mass(self):
+        return np.sum(self.count[0])
+
+    def _freeze_buffers(self, view):
+        if self._shm is not None:
+            view.count = np.array(self.count)
+        else:
+            view.count = self.count.view()
+        view.count.flags.writeable = False
+
+    def _copy_buffers(self):
+        if self._shm is None:
+            self.count = np.array(self.count)
+
+    def _add_counts(self, other):
+        """
+        Adds the counters of a compatible sketch
+        """
+        # The sum is computed once in int64, and checked for overflow by _write_count
+        self._write_count(self.count.astype(np.int64) + other._matrix())
+
+    def _empty_copy(self):
+        """
+        Returns an empty sketch with the same configuration and hash functions
+        """
+        other = self.__class__.__new__(self.__class__)
+        other.__dict__.update(self.__dict__)
+        other._shm = None
+        other.hash_functions = [other.__generate_hash_function(other.seed+i) for i in range(other.d)]
+        other._rng = self._spawn_rng()
+        other.reset()
+        return other
+
+    def share(self):
+        """
+        Moves the counter matrix into a shared memory block.
+
+        Returns the name of the block. Other processes can attach to it with
+        CMS.attach, or simply receive this sketch through pickling, and then
+        query and update the same counters without copying them. Concurrent
+        writers are not synchronized: updates from different processes must
+        be serialized by the caller (e.g. with a multiprocessing.Lock).
+
+        The sketch owns the block and unlinks it when close() is called, or
+        at the latest when the sketch is garbage collected. Copies inherited
+        by forked processes only detach from it.
+        """
+        self.flush()
+        if self._shm is not None:
+            return self._shm.name
+        shm = shared_memory.SharedMemory(create=True, size=max(1, self.count.nbytes))
+        count = np.ndarray(self.count.shape, dtype=self.count.dtype, buffer=shm.buf)
+        count[:] = self.count
+        self.count = count
+        self._shm = shm
+        self._shm_finalizer = weakref.finalize(self, _release_shared_memory, shm, os.getpid())
+        return shm.name
+
+    @classmethod
+    def attach(cls, name, d, w, dtype="int32", **kwargs):
+        """
+        Returns a sketch whose counter matrix is the shared memory block with
+        the given name. The remaining arguments must match those of the sketch
+        that created the block.
+        """
+        cms = cls(d, w, **kwargs)
+        cms._attach_shared_memory(name, (d, w), dtype)
+        return cms
+
+    def _attach_shared_memory(self, name, shape, dtype):
+        try:
+            # Only the owner should unlink the block (Python >= 3.13)
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            shm = shared_memory.SharedMemory(name=name)
+            if os.name == "posix":
+                # Otherwise the resource tracker of this process unlinks the
+                # block when the process exits
+                resource_tracker.unregister(shm._name, "shared_memory")
+        self.count = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        self._shm = shm
+        self._shm_finalizer = weakref.finalize(self, _release_shared_memory, shm, None)
+
+    def close(self):
+        """
+        Detaches the sketch from its shared memory block, keeping a private
+        copy of the counters. The block is unlinked if this sketch created it.
+        """
+        if self._shm is None:
+            return
+        self.count = np.array(self.count)
+        self._shm = None
+        self._shm_finalizer()
+
+    def save(self, path, true_count=True):
+        """
+        Writes the sketch to a file that CMS.load can read back.
+
+        The file records d, w, seed, hash family, the conservative flag, the
+        sample rate, the counter matrix and, if true_count is True, the exact counts.
+        """
+        self.flush()
+        header = {"d": self.d, "w": self.w, "seed": self.seed,
+                  "hash_family": self.hash_family, "conservative": self.conservative,
+                  "dtype": self._count_dtype().str, "auto_dtype": self.dtype == "auto",
+                  "sample_rate": self.sample_rate,
+                  "true_count": bool(true_count and self.track_exact)}
+        header = json.dumps(header).encode("utf-8")
+        prefix = len(_FILE_MAGIC) + 8 + len(header)
+        padding = -prefix % _FILE_ALIGN
+        # The file is written under a temporary name and then renamed, so a
+        # sketch loaded from path with mmap=True keeps its counters
+        path = os.path.abspath(os.fspath(path))
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                        dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(_FILE_MAGIC)
+                f.write(struct.pack("<II", _FILE_VERSION, len(header)))
+                f.write(header)
+                f.write(b"\0" * padding)
+                np.ascontiguousarray(self._matrix()).tofile(f)
+                if true_count and self.track_exact:
+                    pickle.dump(dict(self.true_count.items()), f, protocol=pickle.HIGHEST_PROTOCOL)
+            # Same permissions as a file created by open(path, "wb")
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0o666 & ~umask)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path, mmap=True, true_count=True, **kwargs):
+        """
+        Reads a sketch written by CMS.save.
+
+        With mmap=True the counter matrix is opened through np.memmap in
+        copy-on-write mode: loading is almost instantaneous, pages are read
+        on demand, and updates stay in memory without modifying the file.
+        Additional keyword arguments (e.g. engine, cache_size) are passed to
+        the constructor. The exact counts are unpickled, so only load files
+        from trusted sources.
+        """
+        with open(path, "rb") as f:
+            magic = f.read(len(_FILE_MAGIC))
+            if magic != _FILE_MAGIC:
+                raise ValueError("{:s} is not a sketch file.".format(str(path)))
+            version, header_length = struct.unpack("<II", f.read(8))
+            if version > _FILE_VERSION:
+                raise ValueError("Unsupported sketch file version: {:d}.".format(version))
+            header = json.loads(f.read(header_length).decode("utf-8"))
+
+        prefix = len(_FILE_MAGIC) + 8 + header_length
+        offset = prefix + (-prefix % _FILE_ALIGN)
+        shape = (header["d"], header["w"])
+        dtype = np.dtype(header["dtype"])
+
+        kwargs.setdefault("dtype", "auto" if header.get("auto_dtype") else dtype.name)
+        kwargs.setdefault("sample_rate", header.get("sample_rate", 1.0))
+        cms = cls(header["d"], header["w"], seed=header["seed"], conservative=header["conservative"],
+                  hash_family=header["hash_family"], **kwargs)
+        if mmap:
+            cms.count = np.memmap(path, dtype=dtype, mode="c", offset=offset, shape=shape)
+        else:
+            cms.count = np.fromfile(path, dtype=dtype, count=shape[0]*shape[1], offset=offset).reshape(shape)
+        cms._rescan()
+
+        if true_count and header["true_count"]:
+            with open(path, "rb") as f:
+                f.seek(offset + dtype.itemsize * shape[0] * shape[1])
+                cms.true_count.merge(pickle.load(f))
+        return cms
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def is_compatible(self, other):
+        """
+        Checks whether two sketches use the same hash functions
+        """
+        return (self.d, self.w, self.seed, self.hash_family) == (other.d, other.w, other.seed, other.hash_family)
+
+    def merge(self, other):
+        """
+        Adds the counters of another sketch built with the same hash functions.
+
+        For non-conservative sketches the result is the sketch of the two
+        streams combined. For conservative sketches the sum is still an upper
+        bound on the true counts, but it is not the sketch that conservative
+        updates would produce on the combined stream.
+
+        The counter matrix is replaced rather than modified in place, so
+        models holding a reference to the previous matrix are unaffected,
+        unless the matrix lives in shared memory.
+        """
+        self.flush()
+        other.flush()
+        if not self.is_compatible(other):
+            raise ValueError("Cannot merge sketches with different d, w, seed or hash family.")
+        if self.sample_rate != other.sample_rate:
+            raise ValueError("Cannot merge sketches with different sample rates.")
+        self._detach()
+        self._add_counts(other)
+        self.true_count = sum_dict(self.true_count, other.true_count)
+        self._rescan()
+
+        if self.heavy_hitters is not None:
+            # Re-rank the candidates of both trackers on the merged counters
+            candidates = list(self.heavy_hitters.estimates)
+            if other.heavy_hitters is not None:
+                candidates += [x for x in other.heavy_hitters.estimates if x not in self.heavy_hitters]
+            self.heavy_hitters = TopK(self.top_k)
+            self._offer_heavy_hitters(candidates, self.estimate_many(candidates))
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
 
     def __generate_hash_function(self, seed=2021):
         """
@@ -118,61 +697,407 @@ class CMS:
         functions
 
         """
+        if self.hash_family == "multiply-shift":
+            row = seed - self.seed
+            return lambda x: self._hasher([x], self.w)[0, row]
         return lambda x: mmh3.hash(str(x), seed, signed=False) % self.w
 
+    def _candidates(self):
+        """
+        Keys that may be heavy hitters: the tracked top keys if a tracker is
+        attached (choose top_k >= 1/gamma), all keys otherwise
+        """
+        if self.heavy_hitters is not None:
+            return list(self.heavy_hitters.estimates)
+        if not self.track_exact:
+            raise ValueError("Heavy hitters need either top_k or track_exact=True.")
+        return list(self.true_count.keys())
+
+    def _offer_heavy_hitters(self, keys, estimates):
+        for x, cx in zip(keys, estimates):
+            self.heavy_hitters.offer(x, cx)
+
     def heavy_hitters_true(self, gamma):
-        n = np.sum(self.count[0])
+        self.flush()
+        if not self.track_exact:
+            raise ValueError("Exact heavy hitters need track_exact=True.")
+        n = self.rescale(self._row_mass())
         cutoff = np.floor(gamma * n)
         heavy_hitters = defaultdict(lambda: 0)
-        for x in self.true_count.keys():
-            if self.true_count[x] >= cutoff:
-                heavy_hitters[x] = self.true_count[x]
+        if self.heavy_hitters is None:
+            items = self.true_count.items()
+        else:
+            candidates = self._candidates()
+            items = zip(candidates, self.true_count.lookup(candidates))
+        for x, cx in items:
+            if cx >= cutoff:
+                heavy_hitters[x] = cx
         return heavy_hitters
 
     def heavy_hitters_classical(self, gamma):
-        n = np.sum(self.count[0])
+        self.flush()
+        n = self.rescale(self._row_mass())
         cutoff = np.floor(gamma * n)
         heavy_hitters = defaultdict(lambda: 0)
-        for x in self.true_count.keys():
-            cx = self.estimate_count(x)
+        candidates = self._candidates()
+        for x, cx in zip(candidates, self.estimate_many(candidates)):
             if cx >= cutoff:
                 heavy_hitters[x] = cx
         return heavy_hitters
 
 
     def classical_error(self, delta):
-        n = np.sum(self.count[0])
+        self.flush()
+        n = self.rescale(self._row_mass())
         epsilon = np.exp(1)/self.w
         error = np.ceil(n * epsilon).astype(int)
         return error
 
+    def _cache_key(self, x):
+        # Keys hashed alike must share a cache entry, and only those. mmh3
+        # hashes str(x), so e.g. 1 and 1.0 are different keys; multiply-shift
+        # encodes equal numbers and strings alike and other keys by str(x)
+        if self.hash_family == "multiply-shift" and isinstance(x, (int, float, str, bytes, np.number, np.bool_)):
+            return x
+        return str(x)
+
     def apply_hash(self, x):
-        columns = np.zeros((self.d,))
-        for row in range(self.d):
-            columns[row] = self.hash_functions[row](x)
-        return columns.astype(int)
+        if self.cache_size > 0:
+            key = self._cache_key(x)
+            columns = self._hash_cache.get(key)
+            if columns is not None:
+                self._hash_cache.move_to_end(key)
+                self.cache_hits += 1
+                return columns
+            self.cache_misses += 1
+
+        if self.hash_family == "multiply-shift":
+            columns = self._hasher([x], self.w)[0]
+        else:
+            columns = np.zeros((self.d,))
+            for row in range(self.d):
+                columns[row] = self.hash_functions[row](x)
+            columns = columns.astype(int)
+
+        if self.cache_size > 0:
+            # Cached arrays are shared between callers
+            columns.flags.writeable = False
+            self._hash_cache[key] = columns
+            if len(self._hash_cache) > self.cache_size:
+                self._hash_cache.popitem(last=False)
+        return columns
 
-    def update_count(self, x, n=1):
-        self.true_count[x] += 1
-        columns = self.apply_hash(x)
-        c_hat = self.estimate_count(x)
+    def _hash_keys(self, keys):
+        """
+        Returns the (len(keys), d) array of bucket indices of a chunk of keys
 
+        """
+        if self.cache_size > 0:
+            columns = np.empty((len(keys), self.d), dtype=int)
+            for i, x in enumerate(keys):
+                columns[i] = self.apply_hash(x)
+            return columns
+
+        if self.hash_family == "multiply-shift":
+            return self._hasher(keys, self.w)
+
+        columns = np.empty((len(keys), self.d), dtype=int)
         for row in range(self.d):
-            if self.conservative:
-                current_count = self.count[row, columns[row]]
-                new_count = np.maximum(current_count, c_hat + n)
-                self.count[row, columns[row]] = new_count
+            h = self.hash_functions[row]
+            columns[:, row] = np.fromiter((h(x) for x in keys), dtype=int, count=len(keys))
+        return columns
+
+    def columns_many(self, keys):
+        """
+        Returns the (n, d) array of bucket indices of n keys
+
+        """
+        if not isinstance(keys, np.ndarray):
+            keys = list(keys)
+        return self._hash_keys(keys)
+
+    def _min_count(self, columns):
+        return np.min(self._get_cells(columns), axis=-1)
+
+    def rescale(self, counts):
+        """
+        Converts counters of the sketch to the scale of the stream: with
+        sample_rate p < 1 the counters only see a fraction p of the stream,
+        so they are divided by p (and rounded)
+        """
+        if self.sample_rate == 1:
+            return counts
+        return np.rint(np.asarray(counts) / self.sample_rate).astype(int)
+
+    def _spawn_rng(self):
+        # Independent sampling stream for a copy of the sketch
+        return np.random.default_rng(self._rng.integers(2**63))
+
+    def _thin(self, keys, counts=None):
+        """
+        Keeps each occurrence in a chunk of keys with probability
+        sample_rate. Returns the kept keys and their counts (None if the
+        counts are all 1).
+        """
+        if self.sample_rate == 1:
+            return keys, counts
+        if counts is None:
+            kept = self._rng.random(len(keys)) < self.sample_rate
+        else:
+            counts = self._rng.binomial(counts, self.sample_rate)
+            kept = counts > 0
+            counts = counts[kept]
+        if isinstance(keys, np.ndarray):
+            return keys[kept], counts
+        return list(itertools.compress(keys, kept)), counts
+
+    def estimate_many(self, keys):
+        """
+        Returns the (n,) array of count estimates of n keys, read from the
+        counter matrix with a single gather
+
+        """
+        self.flush()
+        if self._load is not None:
+            self._load.queries += len(keys)
+        return self.rescale(self._min_count(self.columns_many(keys)).astype(int))
+
+    def update_many(self, keys, counts=None):
+        """
+        Adds a chunk of keys to the sketch.
+
+        Equivalent to calling update_count(x, n) for every pair of keys and
+        counts, in stream order, but each hash row is evaluated over the whole
+        chunk and the increments are applied with one reduction per row.
+        Conservative sketches are still updated sequentially, since every
+        update depends on the current minimum; with engine="numba" the
+        sequential loop runs in a compiled kernel.
+
+        With sample_rate < 1 the exact counts see the whole chunk, but only
+        the sampled occurrences are hashed and added to the counters, and
+        the bucket indices of the sampled keys are returned. Counting the
+        whole chunk exactly still costs a dictionary update per key, so
+        shedding load pays off fully with track_exact=False.
+
+        If a fixed dtype cannot hold the counters, an OverflowError is raised
+        and neither the counters nor the exact counts are changed.
+
+        """
+        if not isinstance(keys, np.ndarray):
+            keys = list(keys)
+        if counts is not None:
+            counts = np.asarray(counts, dtype=int)
+            assert len(counts) == len(keys)
+        if len(keys) == 0:
+            return None
+        self.flush()
+        self._detach()
+
+        sampled_keys, sampled_counts = self._thin(keys, counts)
+        columns = np.zeros((0, self.d), dtype=int)
+        if len(sampled_keys) > 0:
+            columns = self._hash_keys(sampled_keys)
+            self._apply_columns(sampled_keys, columns, sampled_counts)
+        # Counted once the counters took the chunk
+        if self.track_exact:
+            add_exact_counts(self.true_count, keys, counts)
+        return columns
+
+    def _apply_columns(self, keys, columns, counts=None):
+        """
+        Adds a chunk of keys, given their bucket indices, to the counters
+        (but not to the exact counts)
+        """
+        if self.conservative:
+            self._update_columns_conservative(columns, counts)
+        else:
+            self._update_columns(columns, counts)
+        if self._load is not None:
+            self._load.record_updates(len(keys))
+
+        if self.heavy_hitters is not None:
+            # Estimates only grow, so offering the final one of each key suffices
+            estimates = dict(zip(keys, self._min_count(columns)))
+            self._offer_heavy_hitters(estimates.keys(), estimates.values())
+
+    def _cell_increments(self, columns, counts=None):
+        """
+        Returns the flat indices (row * w + column) of the cells touched by a
+        chunk of updates, with their int64 increments
+        """
+        cells = (self._rows * self.w + columns).reshape(-1)
+        if counts is None:
+            return cells, np.ones(len(cells), dtype=np.int64)
+        return cells, np.repeat(np.asarray(counts, dtype=np.int64), self.d)
+
+    def _update_columns(self, columns, counts=None):
+        if len(columns) < self.w // 8:
+            # Small chunk: update only the touched cells, in O(n d) rather than O(d w)
+            self._add_cells(*self._cell_increments(columns, counts))
+        else:
+            self._add_increments(self._increments(columns, counts), columns)
+
+    def _thread_pool(self):
+        # Threads do not survive a fork: forked copies start their own pool
+        if (self._pool is None) or (self._pool_pid != os.getpid()):
+            self._pool = ThreadPoolExecutor(self.n_threads)
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def _map_rows(self, f):
+        """
+        Calls f(row) for every row, in the thread pool if n_threads > 1
+        """
+        if self.n_threads > 1:
+            list(self._thread_pool().map(f, range(self.d)))
+        else:
+            for row in range(self.d):
+                f(row)
+
+    def _increments(self, columns, counts=None):
+        """
+        Returns the (d, w) int64 matrix of increments of a chunk of updates.
+
+        The rows of a non-conservative sketch are independent, so with
+        n_threads > 1 they are computed in parallel. The NumPy reductions
+        and, with engine="numba", the compiled kernel release the GIL.
+        """
+        increments = np.empty((self.d, self.w), dtype=np.int64)
+        if self.engine == "numba":
+            counts = np.ones(len(columns), dtype=np.int64) if counts is None else counts
+
+        def add_row(row):
+            if self.engine == "numba":
+                increments[row] = 0
+                kernels.add_columns(increments[row], columns[:, row], counts)
             else:
-                self.count[row, columns[row]] += n
+                increments[row] = np.bincount(columns[:, row], weights=counts, minlength=self.w)
+
+        self._map_rows(add_row)
+        return increments
+
+    def _add_increments(self, increments, columns):
+        if self._load is not None:
+            cells = np.nonzero(increments)
+            old = self.count[cells]
+        # Only the cells touched by the chunk (columns) change
+        if self._fits(int(np.max(self._get_cells(columns))) + int(increments.max())):
+            count = self.count
+            self._map_rows(lambda row: np.add(count[row], increments[row], out=count[row], casting="unsafe"))
+        else:
+            self._write_count(self.count.astype(np.int64) + increments)
+        if self._load is not None:
+            self._load.record(cells[0], old, old + increments[cells])
+
+    def _update_columns_conservative(self, columns, counts=None):
+        if counts is None:
+            counts = np.ones(len(columns), dtype=int)
+        if self._load is not None:
+            cells = np.unique(self._rows * self.w + columns)
+            old = self.count.flat[cells]
+        # Each update raises the largest touched counter by at most its increment
+        if self._fits(int(np.max(self._get_cells(columns))) + int(np.sum(counts))):
+            self._conservative_update(self.count, columns, counts)
+        else:
+            count = self.count.astype(np.int64)
+            self._conservative_update(count, columns, counts)
+            self._write_count(count)
+        if self._load is not None:
+            self._load.record(cells // self.w, old, self.count.flat[cells])
+
+    def _conservative_update(self, count, columns, counts):
+        if self.engine == "numba":
+            kernels.conservative_update(count, columns, counts)
+            return
+
+        rows = self._rows
+        for i in range(len(columns)):
+            c_hat = np.min(count[rows, columns[i]])
+            count[rows, columns[i]] = np.maximum(count[rows, columns[i]], c_hat + counts[i])
+
+    def _fits(self, value):
+        return value <= np.iinfo(self._count_dtype()).max
+
+    def _reserve(self, peak):
+        """
+        Makes sure that the counter matrix can hold values up to peak.
 
+        With dtype="auto" the matrix is promoted to the next wider type;
+        with a fixed dtype an OverflowError is raised instead of letting the
+        counters wrap around.
+        """
+        if self._fits(peak):
+            return
+        if self.dtype != "auto":
+            raise OverflowError("Counter value {:d} does not fit in {:s}.".format(peak, str(self._count_dtype())))
+        dtype = next((t for t in _AUTO_DTYPES if peak <= np.iinfo(t).max), None)
+        if dtype is None:
+            raise OverflowError("Counter value {:d} does not fit in {:s}.".format(peak, _AUTO_DTYPES[-1]))
+        if self._shm is not None:
+            raise OverflowError("Cannot promote a counter matrix that lives in shared memory.")
+        self._promote(dtype)
+
+    def _write_count(self, count):
+        """
+        Replaces the counters with the int64 matrix count, promoting the
+        counter dtype if needed
+        """
+        self._reserve(int(count.max()))
+        if self._shm is not None:
+            self.count[:] = count
+        else:
+            self.count = count.astype(self.count.dtype)
+
+    def update_count(self, x, n=1):
+        """
+        Adds n occurrences of key x. Returns the bucket indices of x, or
+        None if the update was buffered (see flush) or no occurrence was
+        sampled (see sample_rate).
+        """
+        if self.buffer_size:
+            self._buffer[x] += n
+            self._buffered += 1
+            if self._buffered >= self.buffer_size:
+                self.flush()
+            return None
+        self._detach()
+        sampled = n
+        if self.sample_rate < 1:
+            sampled = int(self._rng.binomial(n, self.sample_rate))
+        columns = None
+        if sampled > 0:
+            columns = self.apply_hash(x)
+            self._apply_count(x, columns, sampled)
+        if self.track_exact:
+            self.true_count.add(x, n)
         return columns
 
+    def _apply_count(self, x, columns, n=1):
+        """
+        Adds n occurrences of key x, given its bucket indices, to the
+        counters (but not to the exact counts)
+        """
+        current_count = self._get_cells(columns).astype(np.int64)
+        if self.conservative:
+            c_hat = int(np.min(current_count))
+            new_count = np.maximum(current_count, c_hat + n)
+        else:
+            new_count = current_count + n
+        self._reserve(int(np.max(new_count)))
+        self._set_cells(columns, new_count)
+        if self._load is not None:
+            self._load.record(self._rows, current_count, new_count, single=True)
+            self._load.record_updates(1)
+
+        if self.heavy_hitters is not None:
+            self.heavy_hitters.offer(x, self._min_count(columns))
+
     def estimate_count(self, x):
-        value = float("inf")
+        self.flush()
+        if self._load is not None:
+            self._load.queries += 1
         columns = self.apply_hash(x)
-        for row in range(self.d):
-            value = np.minimum(value, self.count[row, columns[row]])
-        return value.astype(int)
+        return self.rescale(self._min_count(columns).astype(int))
 
     def lower_bound(self, x, confidence):
         error = self.classical_error(1.0-confidence)
@@ -181,6 +1106,7 @@ class CMS:
         return lower, None
 
     def print(self):
+        self.flush()
         od = OrderedDict(sorted(self.true_count.items(), key=lambda x:x[1], reverse=True))
 
         results = []
@@ -192,6 +1118,602 @@ class CMS:
         return pd.DataFrame(results)
     
 
+class SparseCMS(CMS):
+    """
+    Count-min sketch that stores only its non-empty buckets.
+
+    The buckets are kept as a sorted array of flat indices (row * w + column)
+    and an array of counters, which costs 8 bytes plus the counter size per
+    non-empty bucket instead of the counter size per bucket. Reads are
+    binary searches, and new buckets are inserted with a copy of the arrays.
+    Once more than fill_threshold * d * w buckets are non-empty the sketch
+    switches to the dense matrix of CMS for good.
+
+    The sketch behaves like CMS: accessing self.count (e.g. from the
+    posterior models) returns the dense matrix, converting the storage.
+    """
+    def __init__(self, d, w, fill_threshold=0.25, **kwargs):
+        assert (fill_threshold > 0) and (fill_threshold <= 1)
+        self.fill_threshold = fill_threshold
+        super().__init__(d, w, **kwargs)
+        self._make_sparse()
+
+    @property
+    def count(self):
+        if self._dense is None:
+            self._densify()
+        return self._dense
+
+    @count.setter
+    def count(self, count):
+        self._dense = count
+        self._index = None
+        self._values = None
+
+    @property
+    def is_sparse(self):
+        return self._dense is None
+
+    def _make_sparse(self):
+        self._dense = None
+        self._index = np.zeros(0, dtype=np.int64)
+        self._values = np.zeros(0, dtype=self._initial_dtype())
+
+    def _densify(self):
+        count = np.zeros((self.d, self.w), dtype=self._values.dtype)
+        count.flat[self._index] = self._values
+        self.count = count
+
+    def reset(self):
+        super().reset()
+        if self._shm is None:
+            self._make_sparse()
+
+    def _matrix(self):
+        if self._dense is not None:
+            return self._dense
+        count = np.zeros((self.d, self.w), dtype=self._values.dtype)
+        count.flat[self._index] = self._values
+        return count
+
+    def _count_dtype(self):
+        if self._dense is not None:
+            return self._dense.dtype
+        return self._values.dtype
+
+    def _promote(self, dtype):
+        if self._dense is not None:
+            super()._promote(dtype)
+        else:
+            self._values = self._values.astype(dtype)
+
+    def _lookup(self, cells):
+        """
+        Returns the positions of the flat indices cells in self._index and
+        whether they are present
+        """
+        pos = np.searchsorted(self._index, cells)
+        found = np.zeros(cells.shape, dtype=bool)
+        inside = pos < len(self._index)
+        found[inside] = self._index[pos[inside]] == cells[inside]
+        return pos, found
+
+    def _read(self, cells):
+        if self._dense is not None:
+            return super()._read(cells)
+        pos, found = self._lookup(cells)
+        values = np.zeros(cells.shape, dtype=self._values.dtype)
+        values[found] = self._values[pos[found]]
+        return values
+
+    def _write(self, cells, values):
+        """
+        Sets the counters of the sorted, distinct flat indices cells
+        """
+        if self._dense is not None:
+            super()._write(cells, values)
+            return
+        pos, found = self._lookup(cells)
+        self._values[pos[found]] = values[found]
+        if not np.all(found):
+            missing = ~found
+            self._index = np.insert(self._index, pos[missing], cells[missing])
+            self._values = np.insert(self._values, pos[missing], values[missing].astype(self._values.dtype))
+            if len(self._index) > self.fill_threshold * self.d * self.w:
+                self._densify()
+
+    def _get_cells(self, columns):
+        if self._dense is not None:
+            return super()._get_cells(columns)
+        return self._read(self._rows * self.w + columns)
+
+    def _set_cells(self, columns, values):
+        if self._dense is not None:
+            super()._set_cells(columns, values)
+        else:
+            self._write(self._rows * self.w + columns, values)
+
+    def _nonzero_cells(self):
+        if self._dense is not None:
+            return super()._nonzero_cells()
+        return self._index, self._values
+
+    def _row_mass(self):
+        if self._dense is not None:
+            return super()._row_mass()
+        return np.sum(self._values[:np.searchsorted(self._index, self.w)])
+
+    def _freeze_buffers(self, view):
+        if self._dense is not None:
+            super()._freeze_buffers(view)
+            return
+        view._index = self._index.view()
+        view._values = self._values.view()
+        view._index.flags.writeable = False
+        view._values.flags.writeable = False
+
+    def _copy_buffers(self):
+        if self._dense is not None:
+            super()._copy_buffers()
+        else:
+            self._index = np.array(self._index)
+            self._values = np.array(self._values)
+
+    def _add_counts(self, other):
+        if self._dense is not None:
+            super()._add_counts(other)
+            return
+        cells, values = other._nonzero_cells()
+        if len(cells) > 0:
+            self._add_cells(cells, values.astype(np.int64))
+
+    def _update_columns(self, columns, counts=None):
+        if self._dense is not None:
+            super()._update_columns(columns, counts)
+            return
+        self._add_cells(*self._cell_increments(columns, counts))
+
+    def _update_columns_conservative(self, columns, counts=None):
+        if self._dense is not None:
+            super()._update_columns_conservative(columns, counts)
+            return
+        if counts is None:
+            counts = np.ones(len(columns), dtype=int)
+        # Run the sequential updates on a compact matrix holding, in each
+        # row, only the buckets touched by this chunk
+        touched = []
+        local_columns = np.empty_like(columns)
+        for row in range(self.d):
+            buckets, local_columns[:, row] = np.unique(columns[:, row], return_inverse=True)
+            touched.append(buckets)
+        local = np.zeros((self.d, max(len(b) for b in touched)), dtype=np.int64)
+        cells = []
+        for row, buckets in enumerate(touched):
+            cells.append(row * self.w + buckets)
+            local[row, :len(buckets)] = self._read(cells[-1])
+        cells = np.concatenate(cells)
+        old = np.concatenate([local[row, :len(b)] for row, b in enumerate(touched)])
+        self._conservative_update(local, local_columns, counts)
+        new = np.concatenate([local[row, :len(b)] for row, b in enumerate(touched)])
+        self._reserve(int(new.max()))
+        if self._load is not None:
+            self._load.record(cells // self.w, old, new)
+        self._write(cells, new)
+
+
+class WindowedCMS(CMS):
+    """
+    Count-min sketch of the most recent events of a stream.
+
+    The window of the last `window` events is split into n_epochs epochs of
+    ceil(window / n_epochs) events. Besides the counter matrix, which always
+    holds the counts of the whole window, the sketch keeps a ring with the
+    increments of each epoch. When the current epoch is full, the oldest one
+    expires: its increments are subtracted from the counter matrix in
+    O(d w) time, without re-ingesting anything. Queries therefore cover
+    between window - epoch_size and window most recent events, and memory is
+    bounded by n_epochs + 1 matrices.
+
+    An event is one key, added by update_count or as an element of
+    update_many. The exact counts, if tracked, are also restricted to the
+    window. Conservative updates cannot be undone by subtraction, so they
+    are not supported.
+
+    ConformalCMS calibrates and evaluates a windowed sketch against the
+    counts in its window (see span); the events after the warm-up must fill
+    the window, so that the warm-up events have expired.
+    """
+    def __init__(self, d, w, window, n_epochs=8, **kwargs):
+        if kwargs.get("conservative", False):
+            raise ValueError("WindowedCMS does not support conservative updates.")
+        if kwargs.get("buffer_size", 0):
+            raise ValueError("WindowedCMS does not support buffered updates.")
+        assert n_epochs > 0
+        assert window >= n_epochs
+        self.window = window
+        self.n_epochs = n_epochs
+        self.epoch_size = int(np.ceil(window / n_epochs))
+        super().__init__(d, w, **kwargs)
+        self._reset_epochs()
+
+    def _reset_epochs(self):
+        self._epochs = np.zeros((self.n_epochs, self.d, self.w), dtype=np.int64)
+        self._epoch_counts = [self.exact_counter() for _ in range(self.n_epochs)]
+        self._current = 0
+        self._filled = 0
+        # Number of events in each epoch
+        self._epoch_events = np.zeros(self.n_epochs, dtype=np.int64)
+
+    def reset(self):
+        super().reset()
+        self._reset_epochs()
+
+    def span(self):
+        """
+        Returns the number of most recent events covered by the counters
+        """
+        return int(self._epoch_events.sum())
+
+    def expire(self):
+        """
+        Starts a new epoch, dropping the oldest one from the window
+        """
+        self._detach()
+        self._current = (self._current + 1) % self.n_epochs
+        oldest = self._epochs[self._current]
+        self._write_count(self.count.astype(np.int64) - oldest)
+        oldest[:] = 0
+        self._epoch_events[self._current] = 0
+        if self.track_exact:
+            for x, c in self._epoch_counts[self._current].items():
+                self.true_count.add(x, -c)
+                if isinstance(self.true_count, dict) and self.true_count[x] == 0:
+                    del self.true_count[x]
+        self._epoch_counts[self._current] = self.exact_counter()
+        self._filled = 0
+        if self.heavy_hitters is not None:
+            # Estimates went down: re-rank the tracked keys
+            candidates = list(self.heavy_hitters.estimates)
+            self.heavy_hitters = TopK(self.top_k)
+            self._offer_heavy_hitters(candidates, self.estimate_many(candidates))
+        self._rescan()
+
+    def update_count(self, x, n=1):
+        if self._filled == self.epoch_size:
+            self.expire()
+        columns = super().update_count(x, n)
+        if self.track_exact:
+            self._epoch_counts[self._current].add(x, n)
+        self._filled += 1
+        self._epoch_events[self._current] += 1
+        return columns
+
+    def update_many(self, keys, counts=None):
+        """
+        Adds a chunk of keys to the sketch, expiring epochs as needed. The
+        chunk is added epoch by epoch: an OverflowError leaves the parts of
+        the chunk that went to earlier epochs in the sketch.
+        """
+        if not isinstance(keys, np.ndarray):
+            keys = list(keys)
+        columns = []
+        start = 0
+        while start < len(keys):
+            if self._filled == self.epoch_size:
+                self.expire()
+            stop = min(len(keys), start + self.epoch_size - self._filled)
+            chunk_counts = None if counts is None else counts[start:stop]
+            columns.append(super().update_many(keys[start:stop], chunk_counts))
+            if self.track_exact:
+                add_exact_counts(self._epoch_counts[self._current], keys[start:stop], chunk_counts)
+            self._filled += stop - start
+            self._epoch_events[self._current] += stop - start
+            start = stop
+        if len(columns) == 0:
+            return None
+        return np.concatenate(columns)
+
+    def _set_cells(self, columns, values):
+        self._epochs[self._current, self._rows, columns] += values - self._get_cells(columns)
+        super()._set_cells(columns, values)
+
+    def _update_columns(self, columns, counts=None):
+        if len(columns) < self.w // 8:
+            cells, increments = self._cell_increments(columns, counts)
+            self._add_cells(cells, increments)
+            np.add.at(self._epochs[self._current].reshape(-1), cells, increments)
+            return
+        increments = self._increments(columns, counts)
+        self._add_increments(increments, columns)
+        self._epochs[self._current] += increments
+
+    def _add_counts(self, other):
+        """
+        Adds the counters of another WindowedCMS with the same window and
+        n_epochs, whose current epoch holds as many events as ours (e.g.
+        sketches of partitions of a stream ingested in step). The epochs are
+        added by age, so each epoch of the result holds the events of both
+        sketches and they keep expiring together.
+        """
+        if not (isinstance(other, WindowedCMS) and
+                (other.window, other.n_epochs, other._filled) == (self.window, self.n_epochs, self._filled)):
+            raise ValueError("Cannot merge windowed sketches whose epochs are not aligned.")
+        super()._add_counts(other)
+        for age in range(self.n_epochs):
+            mine = (self._current - age) % self.n_epochs
+            theirs = (other._current - age) % other.n_epochs
+            self._epochs[mine] += other._epochs[theirs]
+            self._epoch_counts[mine] = sum_dict(self._epoch_counts[mine], other._epoch_counts[theirs])
+            self._epoch_events[mine] += other._epoch_events[theirs]
+
+    def _freeze_buffers(self, view):
+        super()._freeze_buffers(view)
+        view._epochs = self._epochs.view()
+        view._epochs.flags.writeable = False
+        view._epoch_events = self._epoch_events.view()
+        view._epoch_events.flags.writeable = False
+
+    def _copy_buffers(self):
+        super()._copy_buffers()
+        self._epochs = np.array(self._epochs)
+        self._epoch_events = np.array(self._epoch_events)
+        self._epoch_counts = copy.deepcopy(self._epoch_counts)
+
+
+class CMSFamily:
+    """
+    Sketches of different sizes (d, w) of the same stream, built in one pass.
+
+    All members use the same seed and hash family, so the hash functions of
+    a member with d rows are the first d of a member with more rows, and
+    they only differ in how the hash value is reduced to a bucket index in
+    [0, w). The family evaluates every row hash once per key, for the
+    largest d, and derives the bucket indices of each member from it. The
+    members are ordinary CMS objects, identical to sketches of the same
+    size that ingested the stream on their own, and they share a single
+    table of exact counts.
+
+    Additional keyword arguments (e.g. conservative, dtype, top_k) are
+    passed to every member.
+    """
+    def __init__(self, shapes, seed=2021, hash_family="mmh3", **kwargs):
+        assert len(shapes) > 0
+        self.shapes = [(int(d), int(w)) for d, w in shapes]
+        self.seed = seed
+        self.hash_family = hash_family
+        self.members = [CMS(d, w, seed=seed, hash_family=hash_family, **kwargs) for d, w in self.shapes]
+        self.d = max(d for d, _ in self.shapes)
+        if hash_family == "multiply-shift":
+            self._hasher = MultiplyShiftHash(self.d, seed)
+        self.track_exact = self.members[0].track_exact
+        self.true_count = self.members[0].true_count
+        for cms in self.members:
+            cms.true_count = self.true_count
+
+    def __len__(self):
+        return len(self.members)
+
+    def __getitem__(self, i):
+        return self.members[i]
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def _raw_hashes(self, keys):
+        """
+        Returns the (n, d) array of unreduced hash values of n keys
+        """
+        if self.hash_family == "multiply-shift":
+            return self._hasher.raw(encode_keys(keys))
+        raw = np.empty((len(keys), self.d), dtype=np.uint64)
+        for row in range(self.d):
+            raw[:, row] = np.fromiter((mmh3.hash(str(x), self.seed+row, signed=False) for x in keys),
+                                      dtype=np.uint64, count=len(keys))
+        return raw
+
+    def _columns(self, raw, d, w):
+        if self.hash_family == "multiply-shift":
+            return self._hasher.reduce(raw[:, :d], w)
+        return (raw[:, :d] % np.uint64(w)).astype(int)
+
+    def _detach(self):
+        """
+        Applies the buffered updates of the members and gives them private
+        copies of the buffers shared with frozen views
+        """
+        borrowed = any(cms._borrowed for cms in self.members)
+        for cms in self.members:
+            cms.flush()
+            cms._detach()
+        if borrowed:
+            # Frozen views of the members keep the previous exact counts
+            self.true_count = copy.deepcopy(self.true_count)
+        for cms in self.members:
+            cms.true_count = self.true_count
+
+    def update_many(self, keys, counts=None):
+        """
+        Adds a chunk of keys to every member
+        """
+        if not isinstance(keys, np.ndarray):
+            keys = list(keys)
+        if counts is not None:
+            counts = np.asarray(counts, dtype=int)
+            assert len(counts) == len(keys)
+        if len(keys) == 0:
+            return
+        self._detach()
+
+        # With sample_rate < 1 all members see the same sample
+        sampled_keys, sampled_counts = self.members[0]._thin(keys, counts)
+        if len(sampled_keys) > 0:
+            raw = self._raw_hashes(sampled_keys)
+            for cms in self.members:
+                cms._apply_columns(sampled_keys, self._columns(raw, cms.d, cms.w), sampled_counts)
+        if self.track_exact:
+            add_exact_counts(self.true_count, keys, counts)
+
+    def update_count(self, x, n=1):
+        """
+        Adds n occurrences of key x to every member, updating one cell per
+        row as CMS.update_count does
+        """
+        self._detach()
+        sampler = self.members[0]
+        sampled = n
+        if sampler.sample_rate < 1:
+            sampled = int(sampler._rng.binomial(n, sampler.sample_rate))
+        if sampled > 0:
+            raw = self._raw_hashes([x])
+            for cms in self.members:
+                cms._apply_count(x, self._columns(raw, cms.d, cms.w)[0], sampled)
+        if self.track_exact:
+            self.true_count.add(x, n)
+
+
+def _release_shared_memory(shm, owner_pid):
+    try:
+        shm.close()
+    except BufferError:
+        # Views of the block are still alive: the mapping goes away with them
+        pass
+    # Forked children inherit the owner's sketch, but only the owner unlinks
+    if owner_pid == os.getpid():
+        if os.name == "posix":
+            # Processes sharing the owner's resource tracker (e.g. forked
+            # workers) may have unregistered the block when attaching
+            resource_tracker.register(shm._name, "shared_memory")
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            # Unlinked by another process already
+            if os.name == "posix":
+                resource_tracker.unregister(shm._name, "shared_memory")
+
+def _ingest_worker(cms, tasks, results, seed):
+    # Every worker samples (see sample_rate) with its own generator
+    cms._rng = np.random.default_rng(seed)
+    while True:
+        chunk = tasks.get()
+        if chunk is None:
+            break
+        cms.update_many(chunk)
+    results.put(cms)
+
+def _check_workers(workers):
+    if any(p.exitcode not in [None, 0] for p in workers):
+        raise RuntimeError("A worker process failed during parallel ingestion.")
+
+def parallel_ingest(cms, stream_chunks, n_workers=None):
+    """
+    Adds chunks of keys to a non-conservative sketch using worker processes.
+
+    Each worker fills its own empty copy of cms with the chunks it receives,
+    then the copies are merged into cms. Since non-conservative sketches
+    built with the same hash functions add up, the result is identical to
+    calling cms.update_many on every chunk in turn.
+
+    Returns cms.
+    """
+    if cms.conservative:
+        raise ValueError("Conservative sketches depend on the update order and cannot be sharded.")
+    if isinstance(cms, WindowedCMS):
+        raise ValueError("Windowed sketches depend on the update order and cannot be sharded.")
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+
+    template = cms._empty_copy()
+    seeds = cms._rng.integers(2**63, size=n_workers)
+    tasks = multiprocessing.Queue(maxsize=2*n_workers)
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_ingest_worker, args=(template, tasks, results, seed))
+               for seed in seeds]
+    for p in workers:
+        p.start()
+
+    try:
+        # The task queue is bounded: feeding blocks while all workers are busy
+        for chunk in itertools.chain(stream_chunks, [None]*n_workers):
+            while True:
+                try:
+                    tasks.put(chunk, timeout=1)
+                    break
+                except queue.Full:
+                    _check_workers(workers)
+
+        # Collect the partial sketches before joining, so that workers can exit
+        partials = []
+        while len(partials) < n_workers:
+            try:
+                partials.append(results.get(timeout=1))
+            except queue.Empty:
+                _check_workers(workers)
+    except BaseException:
+        for p in workers:
+            p.terminate()
+        raise
+    for p in workers:
+        p.join()
+
+    for partial in partials:
+        cms.merge(partial)
+    return cms
+
+def copy_stream(stream):
+    """
+    Returns a copy of the stream that emits the same samples. Streams that
+    draw from a fixed corpus (WordStream, StreamFile, DNAStream) share the
+    corpus with the copy, and only their generator is copied.
+    """
+    if isinstance(stream, (WordStream, DNAStream)):
+        stream_copy = copy.copy(stream)
+        stream_copy.prng = copy.deepcopy(stream.prng)
+        return stream_copy
+    return copy.deepcopy(stream)
+
+def snapshot_stream(cms, stream):
+    """
+    Returns a copy of the stream, taken before ingestion, from which the exact
+    counts of the test keys are recovered if cms does not track them
+    """
+    if cms.track_exact:
+        return None
+    return copy_stream(stream)
+
+def exact_counts(cms, keys, snapshot=None, n=0):
+    """
+    Returns the exact counts of keys, read from cms.true_count or, in
+    sketch-only mode, obtained by replaying the first n samples of the
+    stream snapshot for these keys only. For a WindowedCMS only the samples
+    in its window, the last cms.span() of the n, are counted.
+    """
+    if cms.track_exact:
+        cms.flush()
+        return cms.true_count.lookup(keys).tolist()
+    skip = max(0, n - cms.span()) if isinstance(cms, WindowedCMS) else 0
+    counts = count_keys(copy_stream(snapshot), n, keys, skip=skip)
+    return [counts[x] for x in keys]
+
+def stream_chunks(stream, n, chunk_size=10000):
+    """
+    Yields the next n samples of the stream in lists of at most chunk_size,
+    to be ingested with update_many
+    """
+    progress = tqdm(total=n, disable=False)
+    for start in range(0, n, chunk_size):
+        chunk = [stream.sample() for _ in range(min(chunk_size, n-start))]
+        progress.update(len(chunk))
+        yield chunk
+    progress.close()
+
+def check_full_stream(cms, method):
+    """
+    Raises a ValueError if cms only sees a sample of the stream: the
+    Bayesian models read the counters as counts of the whole stream
+    """
+    if cms.sample_rate < 1:
+        raise ValueError("{:s} does not support sketches with sample_rate < 1.".format(method))
+
 class BNPCMS(abc.ABC):
 
     @abc.abstractmethod
@@ -222,7 +1744,8 @@ class BNPCMS(abc.ABC):
 
 class BayesianDP(BNPCMS):
     def __init__(self, cms, alpha=None, sigma=None, tau=None, agg_rule="PoE"):
-        self.cms = copy.deepcopy(cms)
+        check_full_stream(cms, "BayesianDP")
+        self.cms = cms.freeze()
         self.C = self.cms.count
         self.params = alpha
         self.rule = agg_rule
@@ -307,9 +1830,12 @@ class BayesianDP(BNPCMS):
 class SmoothedNGG(BNPCMS):
 
     def __init__(self,  cms, train_data, agg_rule="min"):
+        check_full_stream(cms, "SmoothedNGG")
         self.cms = cms
         self.train_data = train_data
         self.rule = agg_rule
+        # The model reads the counters directly: apply buffered updates first
+        self.cms.flush()
         self.C = self.cms.count
         self.posterior_cache = {}
     
@@ -352,9 +1878,10 @@ class BayesianCMS:
             assert (sigma>=0) and (sigma<1)
         if tau is not None:
             assert (tau>=0) and (tau<=1)
+        check_full_stream(cms, "BayesianCMS")
 
         self.stream = stream
-        self.cms = copy.deepcopy(cms)
+        self.cms = cms.freeze()
         self.params = alpha
         self.sigma = sigma
         self.tau = tau
@@ -370,6 +1897,7 @@ class BayesianCMS:
         ## Process stream
         true_frequency = defaultdict(lambda: 0)
         self.stream.reset()
+        snapshot = snapshot_stream(self.cms, self.stream)
         print("Processing training data....")
         sys.stdout.flush()
         ntrain = int(n * train_perc)
@@ -379,6 +1907,7 @@ class BayesianCMS:
             self.cms.update_count(x)
             if i < ntrain:
                 train_data[i] = x
+        self.cms.flush()
 
         if fitted_model is None:
             # Initialize Bayesian model
@@ -404,7 +1933,6 @@ class BayesianCMS:
         results = []
         for i in tqdm(range(n_test), disable=False):
             x = self.stream.sample()
-            y = self.cms.true_count[x]
 
             if self.two_sided:
                 lower, upper = model.prediction_interval(x, confidence, randomize=True)
@@ -422,10 +1950,14 @@ class BayesianCMS:
 
             # Return results
             results.append({'method':'Bayesian',
-                            'x':x, 'count':y, 'upper': upper, 'lower':lower,
+                            'x':x, 'count':None, 'upper': upper, 'lower':lower,
                             'mean':post_median, 'median':post_median, 'mode':post_mode,
                             'seen':False})
 
+        y_test = exact_counts(self.cms, [r['x'] for r in results], snapshot, n)
+        for r, y in zip(results, y_test):
+            r['count'] = y
+
         results = pd.DataFrame(results)
         results["tracking"] = False
         results = results.sort_values(by=['count'], ascending=False)
@@ -434,7 +1966,7 @@ class BayesianCMS:
 class ClassicalCMS:
     def __init__(self, stream, cms):
         self.stream = stream
-        self.cms = copy.deepcopy(cms)
+        self.cms = cms.freeze()
 
     def run(self, n, n_test, confidence=0.9, seed=None, shift=0):
 
@@ -442,19 +1974,20 @@ class ClassicalCMS:
         ## Process stream
         true_frequency = defaultdict(lambda: 0)
         self.stream.reset()
-        for i in tqdm(range(n), disable=False):
-            x = self.stream.sample()
-            self.cms.update_count(x)
+        snapshot = snapshot_stream(self.cms, self.stream)
+        for chunk in stream_chunks(self.stream, n):
+            self.cms.update_many(chunk)
 
         # Evaluate
         print("Evaluating on test data....")
         sys.stdout.flush()
+        x_test = [self.stream.sample() for i in tqdm(range(n_test), disable=False)]
+        upper_test = self.cms.estimate_many(x_test)
+        error = self.cms.classical_error(1.0-confidence)
+        lower_test = np.maximum(0, upper_test - error).astype(int)
+        y_test = exact_counts(self.cms, x_test, snapshot, n)
         results = []
-        for i in tqdm(range(n_test), disable=False):
-            x = self.stream.sample()
-            y = self.cms.true_count[x]
-            upper = self.cms.estimate_count(x)
-            lower, _ = self.cms.lower_bound(x, confidence)
+        for x, y, upper, lower in zip(x_test, y_test, upper_test, lower_test):
             mean = (upper+lower)/2
             results.append({'method': 'Classical', 'x':x, 'count':y, 'upper': upper, 'lower':lower,
                             'mean':mean, 'median':mean, 'mode':mean,
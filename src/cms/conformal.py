@@ -9,11 +9,10 @@ from scipy.stats.mstats import mquantiles
 from scipy.stats import mannwhitneyu
 from scipy.stats import norm
 from scipy.stats import t as student_t
-import copy
 
-from cms.cms import BayesianCMS, BayesianDP, SmoothedNGG
+from cms.cms import BayesianCMS, BayesianDP, SmoothedNGG, WindowedCMS, snapshot_stream, exact_counts, stream_chunks, check_full_stream
 from cms.cqr import QR, QRScores
-from cms.utils import sum_dict, dictToList, listToDict
+from cms.utils import dictToList, listToDict
 from cms.chr import HistogramAccumulator
 
 from sklearn.ensemble import IsolationForest
@@ -45,9 +44,54 @@ def chunkIt(seq, num):
         last += avg
     return out
 
+def calibrate_scores(scores_cal, y_cal, confidence, n_bins=1, two_sided=False):
+    """
+    Calibrates the conformity scores scores_cal, an (n, 2) array of lower
+    and upper scores, of n calibration points with true counts y_cal.
+
+    The calibration points are split into up to n_bins bins of their true
+    counts and the scores are calibrated within each bin, for bin-conditional
+    coverage. Returns the calibrated (lower, upper) scores.
+    """
+    n_bins_max = int(np.maximum(1, np.floor(len(y_cal)/100)))
+    n_bins = np.minimum(n_bins, n_bins_max)
+    y_bins, y_bin_cutoffs = pd.qcut(y_cal, n_bins, duplicates="drop", labels=False, retbins=True, precision=0)
+    print("Cutoffs for {:d} bins:".format(n_bins))
+    print(y_bin_cutoffs)
+
+    calibrated_scores_bins_low = [None]*n_bins
+    calibrated_scores_bins_upp = [None]*n_bins
+    for k in range(n_bins):
+        idx_bin = np.where(y_bins==k)[0]
+        n_bin = len(idx_bin)
+        alpha = 1.0 - confidence
+        if len(idx_bin) > 0:
+            if two_sided:
+                level_adjusted = (1.0-alpha/2)*(1.0+1.0/float(n_bin))
+            else:
+                level_adjusted = (1.0-alpha)*(1.0+1.0/float(n_bin))
+
+            calibrated_scores_bins_low[k] = mquantiles(scores_cal[idx_bin,0], prob=level_adjusted)[0]
+            calibrated_scores_bins_upp[k] = mquantiles(scores_cal[idx_bin,1], prob=level_adjusted)[0]
+            if not two_sided:
+                calibrated_scores_bins_low[k] = np.ceil(calibrated_scores_bins_low[k]).astype(int)
+                calibrated_scores_bins_upp[k] = np.ceil(calibrated_scores_bins_upp[k]).astype(int)
+        else:
+            calibrated_scores_bins_low[k] = 0
+            calibrated_scores_bins_upp[k] = 0
+    calibrated_score_low = np.max(calibrated_scores_bins_low)
+    calibrated_score_upp = np.max(calibrated_scores_bins_upp)
+    print("Calibrated scores (low):")
+    print(calibrated_scores_bins_low)
+    print("Calibrated scores (upp):")
+    print(calibrated_scores_bins_upp)
+    print("Calibrated score (final):")
+    print([calibrated_score_low, calibrated_score_upp])
+    return calibrated_score_low, calibrated_score_upp
+
 class ClassicalScores:
     def __init__(self, cms, method="constant"):
-        self.cms = copy.deepcopy(cms)
+        self.cms = cms.freeze()
         self.method = method
         delta_t = 1
         self.n = np.sum(self.cms.count[0])
@@ -69,7 +113,7 @@ class ClassicalScores:
 
 class ClassicalScoresTwoSided:
     def __init__(self, cms, method="constant"):
-        self.cms = copy.deepcopy(cms)
+        self.cms = cms.freeze()
         self.method = method
         delta_t = 1
         self.n = np.sum(self.cms.count[0])
@@ -96,7 +140,7 @@ class ClassicalScoresTwoSided:
 class BayesianScores:
     def __init__(self, model, confidence):
         self.model = model
-        self.cms = copy.deepcopy(model.cms)
+        self.cms = model.cms.freeze()
         self.confidence = confidence
         self.t_seq = np.linspace(0, 1, 100)
         self.score_cache = {}
@@ -186,7 +230,7 @@ class BayesianScoresTwoSided:
 
 class BootstrapScores:
     def __init__(self, cms, alpha):
-        self.cms = copy.deepcopy(cms)
+        self.cms = cms.freeze()
         self.alpha = alpha
 
     @lru_cache(maxsize=2048)
@@ -199,7 +243,7 @@ class BootstrapScores:
             J = np.random.choice(w, r)
             if not common_member(I,J):
                 c_J = np.array([self.cms.count[k, J[k]] for k in range(r)])
-                noise[i] = np.min(c_J)
+                noise[i] = self.cms.rescale(np.min(c_J))
                 i = i +1
         return noise
 
@@ -230,7 +274,7 @@ class BootstrapScores:
 
 class BootstrapScoresTwoSided:
     def __init__(self, cms, alpha, n_mc = 1000):
-        self.cms = copy.deepcopy(cms)
+        self.cms = cms.freeze()
         self.n_mc = n_mc
         self.alpha = alpha
 
@@ -244,7 +288,7 @@ class BootstrapScoresTwoSided:
             J = np.random.choice(w, r)
             if not common_member(I,J):
                 c_J = np.array([self.cms.count[k, J[k]] for k in range(r)])
-                noise[i] = np.min(c_J)
+                noise[i] = self.cms.rescale(np.min(c_J))
                 i = i +1
         return noise
 
@@ -280,7 +324,7 @@ class BootstrapScoresTwoSided:
 
 class BootstrapScoresTwoSidedCHR:
     def __init__(self, cms, confidence, n_mc = 1000):
-        self.cms = copy.deepcopy(cms)
+        self.cms = cms.freeze()
         self.alpha = confidence
         self.n_mc = n_mc
         self.t_seq = np.linspace(0, 1, 100)
@@ -297,7 +341,7 @@ class BootstrapScoresTwoSidedCHR:
             J = np.random.choice(w, r)
             if not common_member(I,J):
                 c_J = np.array([self.cms.count[k, J[k]] for k in range(r)])
-                noise[i] = np.min(c_J)
+                noise[i] = self.cms.rescale(np.min(c_J))
                 i = i +1
         return noise
 
@@ -339,6 +383,9 @@ class BootstrapScoresTwoSidedCHR:
 
 class ConformalCMS:
     def __init__(self, stream, cms, n_track, prop_train=0.5, n_bins=1, scorer_type="Bayesian-DP", two_sided=False, unique=1, agg_rule="PoE"):
+        # The calibrated upper bounds are the sketch estimates, which are only
+        # upper bounds if the sketch sees the whole stream
+        check_full_stream(cms, "ConformalCMS")
         self.stream = stream
         self.cms = cms
         self.max_track = n_track
@@ -350,6 +397,14 @@ class ConformalCMS:
         self.agg_rule = agg_rule
         self.model = None
         self.interval_cache = {}
+        # With a windowed sketch, counts refer to the window of the main
+        # stream: the warm-up events have expired by the time of the queries
+        self.windowed = isinstance(cms, WindowedCMS)
+
+    def _warmup_count(self, x):
+        if self.windowed:
+            return 0
+        return self.data_track.get(x, 0)
 
     def _predict_interval(self, x, scorer=None, t_hat_low=None, t_hat_upp=None):
         def get_key():
@@ -358,13 +413,13 @@ class ConformalCMS:
         if scorer is None:
             lower = 0
             upper = self.cms.estimate_count(x)
-            lower_warmup = self.cms_warmup.true_count[x]
+            lower_warmup = self._warmup_count(x)
             return lower + lower_warmup, upper + lower_warmup
         
         cache_key = get_key()
         out = self.interval_cache.get(cache_key, None)
         if out is None:
-            lower_warmup = self.cms_warmup.true_count[x]
+            lower_warmup = self._warmup_count(x)
             if scorer is not None:
                 lower, upper = scorer.predict_interval(x, t_hat_low, t_hat_upp)
                 if hasattr(lower, "__len__"):
@@ -393,7 +448,8 @@ class ConformalCMS:
         sys.stdout.flush()
         self.freq_track = defaultdict(lambda: 0)
         self.data_track = defaultdict(lambda: 0)
-        self.cms_warmup = copy.deepcopy(self.cms)
+        self.cms_warmup = self.cms.freeze()
+        self.snapshot = snapshot_stream(self.cms, self.stream)
         i_range=tqdm(range(self.max_track), disable=False)
         self.train_data = []
         for i in i_range:
@@ -409,13 +465,19 @@ class ConformalCMS:
         print("Main iterations: {:d}...".format(n1))
         sys.stdout.flush()
         # Process stream
-        for i in tqdm(range(n1), disable=False):
-            x = self.stream.sample()
-            self.cms.update_count(x)
+        for chunk in stream_chunks(self.stream, n1):
+            self.cms.update_many(chunk)
+
+            # Check whether these objects are being tracked
+            for x in chunk:
+                if x in self.freq_track:
+                    self.freq_track[x] += 1
 
-            # Check whether this object is being tracked
-            if x in self.freq_track.keys():
-                self.freq_track[x] += 1
+        if self.windowed:
+            # Calibrate against the counts in the window of the sketch
+            keys = list(self.freq_track.keys())
+            for x, y in zip(keys, exact_counts(self.cms, keys, self.snapshot, niter)):
+                self.freq_track[x] = y
 
     def create_and_fit_model(self, confidence):
         n_bins = self.n_bins
@@ -437,6 +499,8 @@ class ConformalCMS:
         sys.stdout.flush()
 
         n1 = n - self.max_track
+        if self.windowed and (n1 < self.cms.window):
+            raise ValueError("With a WindowedCMS, the events after the warm-up (n - n_track) must fill the window.")
         if not reuse_stream:
             self.warmup()
             self.consume_stream(n)
@@ -477,44 +541,11 @@ class ConformalCMS:
             y_cal = np.concatenate([[freq_track[x]]*data_track[x] for x in freq_track.keys()])
 
         # Calibrate the conformity scores (for bin-conditional coverage)
-        n_bins_max = int(np.maximum(1, np.floor(len(y_cal)/100)))
-        n_bins = np.minimum(n_bins, n_bins_max)
-        y_bins, y_bin_cutoffs = pd.qcut(y_cal, n_bins, duplicates="drop", labels=False, retbins=True, precision=0)
-        print("Cutoffs for {:d} bins:".format(n_bins))
-        print(y_bin_cutoffs)
-
-        calibrated_scores_bins_low = [None]*n_bins
-        calibrated_scores_bins_upp = [None]*n_bins
-        for k in range(n_bins):
-            idx_bin = np.where(y_bins==k)[0]
-            n_bin = len(idx_bin)
-            alpha = 1.0 - confidence
-            if len(idx_bin) > 0:
-                if self.two_sided:
-                    level_adjusted = (1.0-alpha/2)*(1.0+1.0/float(n_bin))
-                else:
-                    level_adjusted = (1.0-alpha)*(1.0+1.0/float(n_bin))
-
-                calibrated_scores_bins_low[k] = mquantiles(scores_cal[idx_bin,0], prob=level_adjusted)[0]
-                calibrated_scores_bins_upp[k] = mquantiles(scores_cal[idx_bin,1], prob=level_adjusted)[0]
-                if not self.two_sided:
-                    calibrated_scores_bins_low[k] = np.ceil(calibrated_scores_bins_low[k]).astype(int)
-                    calibrated_scores_bins_upp[k] = np.ceil(calibrated_scores_bins_upp[k]).astype(int)
-            else:
-                calibrated_scores_bins_low[k] = 0
-                calibrated_scores_bins_upp[k] = 0
-        calibrated_score_low = np.max(calibrated_scores_bins_low)
-        calibrated_score_upp = np.max(calibrated_scores_bins_upp)
-        print("Calibrated scores (low):")
-        print(calibrated_scores_bins_low)
-        print("Calibrated scores (upp):")
-        print(calibrated_scores_bins_upp)
-        print("Calibrated score (final):")
-        print([calibrated_score_low, calibrated_score_upp])
-
-        # Combine warm-up and regular cms
-        self.cms.count = self.cms.count + self.cms_warmup.count
-        self.cms.true_count = sum_dict(self.cms.true_count, self.cms_warmup.true_count)
+        calibrated_score_low, calibrated_score_upp = calibrate_scores(scores_cal, y_cal, confidence, n_bins=n_bins, two_sided=self.two_sided)
+
+        # Combine warm-up and regular cms (warm-up events are out of the window)
+        if not self.windowed:
+            self.cms.merge(self.cms_warmup)
 
 
         # Evaluate
@@ -527,7 +558,6 @@ class ConformalCMS:
             if shift > 0:
                 if np.random.rand() < shift:
                     x = x + np.random.rand()
-            y = self.cms.true_count[x]
             lower, upper = self._predict_interval(x, scorer=scorer, t_hat_low=calibrated_score_low, t_hat_upp=calibrated_score_upp)
             tracking = x in freq_track
 
@@ -538,10 +568,14 @@ class ConformalCMS:
                 est_median = (upper+lower)/2
 
             results.append({'method':'Conformal-'+scorer_type,
-                            'x':x, 'count':y, 'upper': upper, 'lower':lower,
+                            'x':x, 'count':None, 'upper': upper, 'lower':lower,
                             'mean':est_median, 'median':est_median, 'mode':est_median,
                             'seen':tracking})
 
+        y_test = exact_counts(self.cms, [r['x'] for r in results], self.snapshot, n)
+        for r, y in zip(results, y_test):
+            r['count'] = y
+
         results = pd.DataFrame(results)
         results = results.sort_values(by=['count'], ascending=False)
         return results
@@ -0,0 +1,250 @@
+"""
+Exact counters of the keys in a stream, used as ground truth by the sketches.
+
+DictCounter keeps the counts in memory, as CMS has always done. SpillCounter
+keeps a bounded in-memory buffer and spills it to disk as runs of
+(key, count) pairs sorted by key code, so that the distinct-key table of
+the stream does not need to fit in memory. Both answer batch lookups with
+lookup(keys) and can be combined with merge(other).
+"""
+import os
+import heapq
+import itertools
+import shutil
+import tempfile
+import uuid
+import weakref
+import numpy as np
+
+from collections import defaultdict
+
+from cms.hashing import encode_keys
+
+
+class DictCounter(defaultdict):
+    """
+    In-memory exact counter: a dict of counts with default value 0
+    """
+    def __init__(self, counts=()):
+        super().__init__(int, counts)
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def copy(self):
+        return self.__class__(self)
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def add(self, x, n=1):
+        self[x] += n
+
+    def add_many(self, keys, counts=None):
+        if counts is None:
+            for x in keys:
+                self[x] += 1
+        else:
+            for x, c in zip(keys, counts):
+                self[x] += c
+
+    def lookup(self, keys):
+        """
+        Returns the counts of keys as an array, without inserting missing keys
+        """
+        return np.array([self.get(x, 0) for x in keys], dtype=np.int64)
+
+    def merge(self, other):
+        """
+        Adds the counts of another counter (or dict) in place
+        """
+        for x, c in other.items():
+            self[x] += c
+        return self
+
+
+def _remove_directory(path, owner_pid):
+    # Forked workers inherit the counter: only the creating process cleans up
+    if os.getpid() == owner_pid:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class _TemporaryDirectory:
+    """
+    Temporary directory removed when no counter refers to it anymore
+    """
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix="cms-counts-")
+        weakref.finalize(self, _remove_directory, self.path, os.getpid())
+
+
+class SpillCounter:
+    """
+    Exact counter backed by sorted runs on disk.
+
+    Counts are accumulated in a dict of at most buffer_size keys. When the
+    buffer is full it is written to the directory as a run: the 64-bit codes
+    of its keys (see cms.hashing.encode_keys) in increasing order, with the
+    keys and counts in the same order. A key may appear in several runs, its
+    count being the sum of its entries.
+
+    lookup(keys) sorts the query codes and locates them in each run with a
+    binary search over the memory-mapped code arrays, so only the pages of
+    the runs that contain queried keys are read. Keys with the same code are
+    told apart by comparing the keys themselves, so the counts are exact.
+
+    If directory is None, a temporary directory is created and removed when
+    the counter and its deep copies are garbage collected.
+    """
+    def __init__(self, directory=None, buffer_size=1000000):
+        assert buffer_size > 0
+        self.buffer_size = buffer_size
+        self.buffer = defaultdict(int)
+        self.runs = []
+        self._temporary = None
+        if directory is None:
+            self._temporary = _TemporaryDirectory()
+            directory = self._temporary.path
+        else:
+            os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Unpickled copies refer to the same runs but never remove the directory
+        state["_temporary"] = None
+        state["buffer"] = dict(self.buffer)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.buffer = defaultdict(int, self.buffer)
+
+    def __deepcopy__(self, memo):
+        # Runs are never modified, so deep copies share them and the directory
+        other = self.__class__.__new__(self.__class__)
+        other.__dict__.update(self.__dict__)
+        other.buffer = defaultdict(int, self.buffer)
+        other.runs = list(self.runs)
+        return other
+
+    def __getitem__(self, x):
+        return int(self.lookup([x])[0])
+
+    def add(self, x, n=1):
+        self.buffer[x] += n
+        if len(self.buffer) >= self.buffer_size:
+            self.spill()
+
+    def add_many(self, keys, counts=None):
+        if counts is None:
+            counts = itertools.repeat(1)
+        for x, c in zip(keys, counts):
+            self.add(x, c)
+
+    def spill(self):
+        """
+        Writes the buffer to disk as a sorted run
+        """
+        if len(self.buffer) == 0:
+            return
+        keys = list(self.buffer.keys())
+        counts = np.fromiter(self.buffer.values(), dtype=np.int64, count=len(keys))
+        codes = encode_keys(keys)
+        order = np.argsort(codes, kind="stable")
+        if len(set(map(type, keys))) == 1 and isinstance(keys[0], (int, float, str, np.number)):
+            values = np.asarray(keys)
+        else:
+            # NumPy would convert mixed keys to a common type: keep the objects
+            values = np.empty(len(keys), dtype=object)
+            for i, x in enumerate(keys):
+                values[i] = x
+        run = os.path.join(self.directory, uuid.uuid4().hex)
+        np.save(run + ".codes.npy", codes[order])
+        np.save(run + ".keys.npy", values[order], allow_pickle=values.dtype.kind == "O")
+        np.save(run + ".counts.npy", counts[order])
+        self.runs.append(run)
+        self.buffer = defaultdict(int)
+
+    def _load_run(self, run):
+        codes = np.load(run + ".codes.npy", mmap_mode="r")
+        counts = np.load(run + ".counts.npy", mmap_mode="r")
+        try:
+            keys = np.load(run + ".keys.npy", mmap_mode="r")
+        except ValueError:
+            # Arrays of Python objects cannot be memory-mapped
+            keys = np.load(run + ".keys.npy", allow_pickle=True)
+        return codes, keys, counts
+
+    def lookup(self, keys):
+        """
+        Returns the exact counts of keys as an array
+        """
+        keys = list(keys)
+        result = np.array([self.buffer.get(x, 0) for x in keys], dtype=np.int64)
+        if len(keys) == 0 or len(self.runs) == 0:
+            return result
+        codes = encode_keys(keys)
+        order = np.argsort(codes, kind="stable")
+        codes = codes[order]
+        for run in self.runs:
+            run_codes, run_keys, run_counts = self._load_run(run)
+            left = np.searchsorted(run_codes, codes, side="left")
+            right = np.searchsorted(run_codes, codes, side="right")
+            for i in np.where(right > left)[0]:
+                x = keys[order[i]]
+                for j in range(left[i], right[i]):
+                    if run_keys[j] == x:
+                        result[order[i]] += run_counts[j]
+        return result
+
+    def _iter_run(self, run):
+        codes, keys, counts = self._load_run(run)
+        for j in range(len(codes)):
+            yield int(codes[j]), keys[j].item() if isinstance(keys[j], np.generic) else keys[j], int(counts[j])
+
+    def items(self):
+        """
+        Iterates over (key, count) pairs, merging the sorted runs
+        """
+        self.spill()
+        group_code = None
+        group = {}
+        for code, x, c in heapq.merge(*[self._iter_run(run) for run in self.runs], key=lambda e: e[0]):
+            if code != group_code:
+                yield from group.items()
+                group_code = code
+                group = {}
+            group[x] = group.get(x, 0) + c
+        yield from group.items()
+
+    def keys(self):
+        for x, _ in self.items():
+            yield x
+
+    def merge(self, other):
+        """
+        Adds the counts of another counter (or dict) in place. The runs of
+        another SpillCounter are copied into this directory.
+        """
+        if isinstance(other, SpillCounter):
+            for run in other.runs:
+                copy = os.path.join(self.directory, uuid.uuid4().hex)
+                for suffix in [".codes.npy", ".keys.npy", ".counts.npy"]:
+                    shutil.copyfile(run + suffix, copy + suffix)
+                self.runs.append(copy)
+            other = other.buffer
+        for x, c in other.items():
+            self.add(x, c)
+        return self
+
+    def cleanup(self):
+        """
+        Removes the runs of this counter from disk
+        """
+        for run in self.runs:
+            for suffix in [".codes.npy", ".keys.npy", ".counts.npy"]:
+                if os.path.exists(run + suffix):
+                    os.remove(run + suffix)
+        self.runs = []
+        self.buffer = defaultdict(int)
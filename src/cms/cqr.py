@@ -155,7 +155,7 @@ class QRScores:
     Higher scores result in more conservative bounds.
     """
     def __init__(self, cms, confidence, seed, two_sided=False):
-        self.cms = copy.deepcopy(cms)
+        self.cms = cms.freeze()
         self.two_sided = two_sided
         alpha = 1.0 - confidence
         if self.two_sided:
@@ -262,6 +262,36 @@ class DP:
             data = x
         return data
 
+class Vocabulary:
+    """ Dictionary encoding of string keys as dense int32 ids """
+    def __init__(self, keys):
+        # Sorted array of distinct keys: the id of a key is its position
+        self.keys = np.asarray(keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def encode(self, keys):
+        """ Returns the ids of the given keys (-1 for unknown keys) """
+        keys = np.asarray(keys)
+        ids = np.searchsorted(self.keys, keys)
+        ids = np.minimum(ids, len(self.keys)-1)
+        known = (len(self.keys) > 0) & (self.keys[ids] == keys)
+        return np.where(known, ids, -1).astype(np.int32)
+
+    def decode(self, ids):
+        """ Returns the keys corresponding to the given ids """
+        return self.keys[np.asarray(ids)]
+
+def intern_keys(data):
+    """
+    Maps each distinct key in data to a dense int32 id.
+
+    Returns the array of ids and the Vocabulary that recovers the keys.
+    """
+    keys, ids = np.unique(data, return_inverse=True)
+    return ids.astype(np.int32).reshape(-1), Vocabulary(keys)
+
 def extract_ngrams(s, n, words):
     s = s.lower()
     sentences = sent_tokenize(s)
@@ -272,7 +302,7 @@ def extract_ngrams(s, n, words):
     return data_ngrams
 
 class WordStream:
-    def __init__(self, n_docs=100, n_grams=2, seed=2021, filename_out=None):
+    def __init__(self, n_docs=100, n_grams=2, seed=2021, filename_out=None, intern=False):
         file_list = nltk.corpus.gutenberg.fileids()
         n_docs = np.minimum(n_docs, len(file_list))
         self.data = []
@@ -290,9 +320,20 @@ class WordStream:
                 print("List of {:d} tuples written to: {:s}".format(len(self.data), filename_out))
                 sys.stdout.flush()
 
+        self.vocabulary = None
+        if intern:
+            self.intern()
+
         self.counter = 0
         self.prng = RandomState(seed)
 
+    def intern(self):
+        """
+        Replaces the stored keys with dense int32 ids, so that the stream
+        emits ids. The original keys are recovered with self.vocabulary.
+        """
+        self.data, self.vocabulary = intern_keys(self.data)
+
     def set_seed(self, seed):
         self.prng = RandomState(seed)
 
@@ -364,12 +405,16 @@ class DNAStream:
 
 
 class StreamFile(WordStream):
-    def __init__(self, filename, seed=2021):
+    def __init__(self, filename, seed=2021, intern=False):
         with open(filename,'r') as data_file:
             rd = csv.reader(data_file, dialect='excel')
             self.data = list(rd)
             self.data = np.concatenate(self.data)
 
         print("Loaded {:d} data points.".format(len(self.data)))
+        self.vocabulary = None
+        if intern:
+            self.intern()
+            print("Interned {:d} distinct keys.".format(len(self.vocabulary)))
         self.counter = 0
         self.prng = RandomState(seed)
@@ -0,0 +1,174 @@
+"""
+Hierarchical count-min sketch for range and quantile queries over integer
+keys.
+"""
+import numpy as np
+
+from cms.cms import CMS
+from cms.conformal import calibrate_scores
+
+
+def dyadic_cover(a, b):
+    """
+    Decomposes the range [a, b) into at most two dyadic intervals per level.
+
+    Returns a list of (level, index) pairs: the pair (l, i) stands for the
+    keys in [i * 2^l, (i + 1) * 2^l).
+    """
+    cover = []
+    level = 0
+    while a < b:
+        if a & 1:
+            cover.append((level, a))
+            a += 1
+        if b & 1:
+            b -= 1
+            cover.append((level, b))
+        a >>= 1
+        b >>= 1
+        level += 1
+    return cover
+
+
+class DyadicCMS:
+    """
+    Count-min sketches of the integer keys in [0, 2^n_bits) at every dyadic
+    resolution.
+
+    Level l is a CMS of the keys shifted right by l bits, so that its
+    counters estimate the counts of the intervals [i * 2^l, (i + 1) * 2^l).
+    All levels are fed by the same ingestion call and use the multiply-shift
+    hash family, which hashes whole arrays of integer keys at once. A range
+    [a, b) is covered by at most two intervals per level, so range counts
+    and quantiles take O(n_bits) point queries.
+
+    Additional keyword arguments (e.g. conservative, dtype) are passed to
+    every level. Only level 0 keeps the exact counts, if track_exact=True.
+    """
+    def __init__(self, d, w, n_bits=32, seed=2021, track_exact=True, **kwargs):
+        assert (n_bits > 0) and (n_bits < 63)
+        self.d = d
+        self.w = w
+        self.n_bits = n_bits
+        self.seed = seed
+        self.levels = [CMS(d, w, seed=seed+level*d, hash_family="multiply-shift",
+                           track_exact=track_exact and level == 0, **kwargs)
+                       for level in range(n_bits+1)]
+        self.n = 0
+
+    def _check_keys(self, keys):
+        keys = np.asarray(keys).reshape(-1)
+        assert keys.dtype.kind in "iu", "DyadicCMS only counts integer keys"
+        if len(keys) > 0:
+            assert (keys.min() >= 0) and (keys.max() >> self.n_bits == 0), "Keys must lie in [0, 2^n_bits)"
+        return keys.astype(np.int64)
+
+    def update_many(self, keys, counts=None):
+        keys = self._check_keys(keys)
+        for level, cms in enumerate(self.levels):
+            cms.update_many(keys >> level, counts)
+        self.n += len(keys) if counts is None else int(np.sum(counts))
+
+    def update_count(self, x, n=1):
+        self.update_many([x], [n])
+
+    def estimate_count(self, x):
+        return self.levels[0].estimate_count(x)
+
+    def range_count(self, a, b):
+        """
+        Returns an upper bound on the number of keys in [a, b)
+        """
+        a = max(int(a), 0)
+        b = min(int(b), 1 << self.n_bits)
+        cover = dyadic_cover(a, b)
+        count = 0
+        for level in set(l for l, _ in cover):
+            nodes = [i for l, i in cover if l == level]
+            count += int(np.sum(self.levels[level].estimate_many(nodes)))
+        return count
+
+    def true_range_count(self, a, b):
+        """
+        Returns the exact number of keys in [a, b), from the exact counts
+        """
+        return sum(c for x, c in self.levels[0].true_count.items() if (x >= a) and (x < b))
+
+    def quantile(self, q):
+        """
+        Returns an approximate q-quantile of the keys: the smallest key x
+        such that the estimated number of keys <= x is at least q * n
+        """
+        assert (q >= 0) and (q <= 1)
+        target = q * self.n
+        rank = 0
+        node = 0
+        for level in range(self.n_bits-1, -1, -1):
+            node = 2 * node
+            left = int(self.levels[level].estimate_count(node))
+            if rank + left < target:
+                rank += left
+                node += 1
+        return node
+
+    def merge(self, other):
+        assert (self.n_bits == other.n_bits) and (self.seed == other.seed)
+        for cms, other_cms in zip(self.levels, other.levels):
+            cms.merge(other_cms)
+        self.n += other.n
+        return self
+
+    def freeze(self):
+        view = self.__class__.__new__(self.__class__)
+        view.__dict__.update(self.__dict__)
+        view.levels = [cms.freeze() for cms in self.levels]
+        return view
+
+    def calibrate(self, ranges, counts, confidence=0.9, n_bins=1, two_sided=False):
+        """
+        Calibrates conformal bounds for range counts, with the calibration
+        machinery of ConformalCMS.
+
+        ranges: calibration ranges (a, b), exchangeable with the test ranges
+        counts: their true counts in the sketched stream
+
+        The bounds returned by range_interval refer to the sketch as it was
+        when this method was called.
+        """
+        self.range_scorer = RangeScores(self, two_sided=two_sided)
+        scores_cal = np.array([self.range_scorer.compute_score(r, y) for r, y in zip(ranges, counts)])
+        self.t_hat = calibrate_scores(scores_cal, np.asarray(counts), confidence, n_bins=n_bins, two_sided=two_sided)
+        return self.t_hat
+
+    def range_interval(self, a, b):
+        """
+        Returns the conformal (lower, upper) bounds on the count of [a, b)
+        """
+        assert hasattr(self, "t_hat"), "range_interval can be called only after calibrate"
+        return self.range_scorer.predict_interval((a, b), *self.t_hat)
+
+
+class RangeScores:
+    """
+    Conformity scores of range counts, like ClassicalScores (one-sided) and
+    ClassicalScoresTwoSided for point counts
+    """
+    def __init__(self, dyadic, two_sided=False):
+        self.cms = dyadic.freeze()
+        self.two_sided = two_sided
+
+    def compute_score(self, x, y):
+        upper = self.cms.range_count(*x)
+        if self.two_sided:
+            return upper-y, y-upper
+        return upper-y, 0
+
+    def predict_interval(self, x, tau_l, tau_u):
+        upper = self.cms.range_count(*x)
+        lower = int(np.maximum(0, upper - tau_l))
+        if self.two_sided:
+            upper = int(np.maximum(lower, np.minimum(upper, upper + tau_u)))
+        return lower, upper
+
+    def name(self):
+        return "range2s" if self.two_sided else "range1s"
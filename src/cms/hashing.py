@@ -0,0 +1,109 @@
+"""
+Vectorized hash families for the count-min sketch.
+
+The default family of CMS formats every key with str() and hashes it with
+murmur, one key and one row at a time. The families in this module work on
+whole arrays of keys instead: keys are first mapped to a canonical 64-bit
+code and all d rows are then evaluated with NumPy integer arithmetic.
+"""
+import numpy as np
+import mmh3
+
+_MASK_64 = (1 << 64) - 1
+
+
+def _encode_float(x):
+    if np.isfinite(x) and x == np.floor(x) and abs(x) < 2**63:
+        return int(x) & _MASK_64
+    return int(np.float64(x).view(np.uint64))
+
+
+def _encode_scalar(x):
+    if isinstance(x, (bool, np.bool_)):
+        return int(x)
+    if isinstance(x, (int, np.integer)):
+        return int(x) & _MASK_64
+    if isinstance(x, (float, np.floating)):
+        return _encode_float(x)
+    if isinstance(x, str):
+        x = x.encode("utf-8")
+    if not isinstance(x, bytes):
+        x = str(x).encode("utf-8")
+    return mmh3.hash64(x, 0, signed=False)[0]
+
+
+def encode_keys(keys):
+    """
+    Maps keys to canonical 64-bit codes, without formatting them as strings.
+
+    Keys that compare equal in Python get the same code: integers are
+    encoded by their two's complement, floats with an integral value are
+    encoded like the corresponding integer, other floats by their IEEE-754
+    bits, and strings or bytes by a 64-bit murmur hash of their bytes.
+
+    Returns a (n,) uint64 array.
+    """
+    values = keys
+    if isinstance(keys, np.ndarray):
+        keys = keys.reshape(-1)
+    else:
+        values = list(keys)
+        try:
+            keys = np.asarray(values)
+        except ValueError:
+            keys = None
+        if keys is None or keys.ndim != 1:
+            # Sequence keys (e.g. tuples) are single keys, not array rows
+            keys = np.empty(len(values), dtype=object)
+            for i, x in enumerate(values):
+                keys[i] = x
+    if keys.dtype.kind in "US" and not isinstance(values, np.ndarray):
+        # NumPy turns mixed lists into strings: encode the original objects
+        return np.fromiter((_encode_scalar(x) for x in values), dtype=np.uint64, count=len(values))
+    if keys.dtype.kind in "biu":
+        return keys.astype(np.int64).view(np.uint64)
+    if keys.dtype.kind == "f":
+        keys = keys.astype(np.float64)
+        with np.errstate(invalid="ignore"):
+            integral = np.isfinite(keys) & (keys == np.floor(keys)) & (np.abs(keys) < 2**63)
+        codes = keys.view(np.uint64).copy()
+        codes[integral] = keys[integral].astype(np.int64).view(np.uint64)
+        return codes
+    return np.fromiter((_encode_scalar(x) for x in keys), dtype=np.uint64, count=len(keys))
+
+
+class MultiplyShiftHash:
+    """
+    Family of d strongly universal hash functions (vector multiply-shift).
+
+    Row r maps a 64-bit code x = (hi, lo) to the 32-bit value
+        h_r(x) = ((a0 * lo + a1 * hi + b) mod 2^64) >> 32
+    with multipliers drawn from a generator seeded with seed + r, and the
+    bucket index is obtained as (h_r(x) * w) >> 32.
+    """
+    def __init__(self, d, seed=2021):
+        self.d = d
+        self.seed = seed
+        params = [np.random.Generator(np.random.PCG64(seed + row)).bit_generator.random_raw(3) for row in range(d)]
+        params = np.array(params, dtype=np.uint64)
+        self.a0 = params[:, 0]
+        self.a1 = params[:, 1]
+        self.b = params[:, 2]
+
+    def raw(self, codes):
+        """
+        Returns the (n, d) array of 32-bit hash values of n key codes
+        """
+        codes = codes.reshape(-1, 1)
+        lo = codes & np.uint64(0xFFFFFFFF)
+        hi = codes >> np.uint64(32)
+        return (self.a0 * lo + self.a1 * hi + self.b) >> np.uint64(32)
+
+    def reduce(self, raw, w):
+        """
+        Maps 32-bit hash values to bucket indices in [0, w)
+        """
+        return ((raw * np.uint64(w)) >> np.uint64(32)).astype(int)
+
+    def __call__(self, keys, w):
+        return self.reduce(self.raw(encode_keys(keys)), w)
@@ -0,0 +1,50 @@
+"""
+Compiled kernels for the sequential parts of sketch ingestion.
+
+Numba is an optional dependency: when it is not installed the same
+functions run as plain Python loops, which give identical results.
+"""
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _conservative_update(count, columns, counts):
+    """
+    Applies conservative updates to the counter matrix in stream order.
+
+    count:   (d, w) counter matrix, updated in place
+    columns: (n, d) bucket indices of the n keys
+    counts:  (n,) increments of the n keys
+    """
+    d = columns.shape[1]
+    for i in range(columns.shape[0]):
+        c_hat = count[0, columns[i, 0]]
+        for row in range(1, d):
+            c = count[row, columns[i, row]]
+            if c < c_hat:
+                c_hat = c
+        target = c_hat + counts[i]
+        for row in range(d):
+            if count[row, columns[i, row]] < target:
+                count[row, columns[i, row]] = target
+
+
+def _add_columns(increments, columns, counts):
+    """
+    Adds counts[i] to increments[columns[i]] for every i, in one row of the
+    counter matrix.
+    """
+    for i in range(columns.shape[0]):
+        increments[columns[i]] += counts[i]
+
+
+if numba is not None:
+    # nogil: rows can be processed by several threads at once
+    conservative_update = numba.njit(nogil=True)(_conservative_update)
+    add_columns = numba.njit(nogil=True)(_add_columns)
+else:
+    conservative_update = _conservative_update
+    add_columns = _add_columns
+
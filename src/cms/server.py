@@ -0,0 +1,272 @@
+"""
+asyncio service that ingests keys received over a socket into a sketch.
+
+Clients connect to a local TCP or Unix socket and send keys, either one per
+line (framing="newline") or each preceded by its length as a 4-byte
+big-endian integer (framing="length"). Keys are decoded as UTF-8 strings
+and, if a decode function is given (e.g. decode=int), converted with it, so
+that they match the keys of the other producers of the sketch. Frames that
+are longer than max_key_size bytes, not valid UTF-8 or rejected by decode
+(with a ValueError) are skipped.
+"""
+import asyncio
+import logging
+import signal
+import struct
+
+from concurrent.futures import ThreadPoolExecutor
+
+_LENGTH = struct.Struct("!I")
+
+logger = logging.getLogger(__name__)
+
+# Returned by _read_key for a frame that was skipped
+_REJECTED = object()
+
+
+class IngestServer:
+    """
+    Collects the keys sent by clients into micro-batches and adds them to
+    cms with update_many.
+
+    Received keys go through a queue of at most max_pending keys: when it
+    is full, connections stop being read until the sketch catches up, so
+    TCP flow control slows the clients down. A batch is applied once it
+    holds batch_size keys or flush_interval seconds after its first key.
+    Batches are applied one at a time on a dedicated thread, so the event
+    loop keeps accepting keys while the sketch is updated and the sketch is
+    never updated concurrently. If update_many fails (e.g. with an
+    OverflowError), the error is logged, the keys of the batch are counted
+    in failed and the server goes on with the next batch.
+
+    stop() stops accepting connections, closes the open ones, applies the
+    keys already received and, if save_path is given, saves the sketch with
+    cms.save.
+    """
+    def __init__(self, cms, host="127.0.0.1", port=0, path=None, framing="newline",
+                 batch_size=10000, flush_interval=1.0, max_pending=100000, save_path=None,
+                 max_key_size=65536, decode=None):
+        assert framing in ["newline", "length"]
+        assert (batch_size > 0) and (max_pending > 0) and (flush_interval > 0) and (max_key_size > 0)
+        self.cms = cms
+        self.host = host
+        self.port = port
+        # Unix socket path; a TCP socket is used if None
+        self.path = path
+        self.framing = framing
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.save_path = save_path
+        self.max_key_size = max_key_size
+        # Converts the received strings to keys, e.g. int
+        self.decode = decode
+        self.received = 0
+        self.applied = 0
+        self.failed = 0
+        # Frames skipped because they are too long, not valid UTF-8 or not
+        # accepted by decode
+        self.rejected = 0
+        self.address = None
+        self._server = None
+        self._queue = None
+        self._batcher = None
+        self._executor = None
+        self._connections = {}
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._executor = ThreadPoolExecutor(1)
+        self._batcher = asyncio.ensure_future(self._run_batches())
+        if self.path is None:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port, limit=self._limit())
+            self.address = self._server.sockets[0].getsockname()
+        else:
+            self._server = await asyncio.start_unix_server(self._handle, self.path, limit=self._limit())
+            self.address = self.path
+        return self.address
+
+    def _limit(self):
+        # Buffer size of the connections: a line longer than this is skipped
+        return max(self.max_key_size + 2, 2**16)
+
+    async def _skip(self, reader, n):
+        """
+        Discards the next n bytes of a connection, without buffering them.
+        Returns False if the connection ended first.
+        """
+        while n > 0:
+            data = await reader.read(min(n, 2**16))
+            if not data:
+                return False
+            n -= len(data)
+        return True
+
+    async def _read_frame(self, reader):
+        """
+        Returns the next frame (without framing), None at the end, or
+        _REJECTED for a frame longer than max_key_size
+        """
+        if self.framing == "length":
+            try:
+                header = await reader.readexactly(_LENGTH.size)
+            except asyncio.IncompleteReadError:
+                return None
+            size = _LENGTH.unpack(header)[0]
+            if size > self.max_key_size:
+                return _REJECTED if await self._skip(reader, size) else None
+            try:
+                return await reader.readexactly(size)
+            except asyncio.IncompleteReadError:
+                return None
+        try:
+            line = await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            # Last line, without terminator
+            line = e.partial
+            if not line:
+                return None
+        except asyncio.LimitOverrunError as e:
+            # Drop the line up to its terminator
+            while True:
+                await reader.readexactly(e.consumed)
+                try:
+                    await reader.readuntil(b"\n")
+                    return _REJECTED
+                except asyncio.IncompleteReadError:
+                    return None
+                except asyncio.LimitOverrunError as overrun:
+                    e = overrun
+        line = line.rstrip(b"\r\n")
+        if len(line) > self.max_key_size:
+            return _REJECTED
+        return line
+
+    async def _read_key(self, reader):
+        """
+        Returns the next key sent on a connection, None at the end, or
+        _REJECTED for a frame that was skipped
+        """
+        while True:
+            frame = await self._read_frame(reader)
+            if (frame is None) or (frame is _REJECTED):
+                return frame
+            if self.framing == "newline" and not frame:
+                # Empty lines are ignored
+                continue
+            try:
+                key = frame.decode("utf-8")
+                if self.decode is not None:
+                    key = self.decode(key)
+                return key
+            except ValueError:
+                # Includes UnicodeDecodeError
+                return _REJECTED
+
+    async def _handle(self, reader, writer):
+        self._connections[asyncio.current_task()] = writer
+        try:
+            while True:
+                key = await self._read_key(reader)
+                if key is None:
+                    break
+                if key is _REJECTED:
+                    self.rejected += 1
+                    continue
+                # Blocks while max_pending keys are waiting: backpressure
+                await self._queue.put(key)
+                self.received += 1
+        except ConnectionError:
+            pass
+        finally:
+            del self._connections[asyncio.current_task()]
+            writer.close()
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        done = False
+        while not done:
+            key = await self._queue.get()
+            if key is None:
+                break
+            batch = [key]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    key = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        key = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if key is None:
+                    done = True
+                    break
+                batch.append(key)
+            try:
+                await loop.run_in_executor(self._executor, self.cms.update_many, batch)
+            except Exception:
+                logger.exception("Could not add a batch of %d keys to the sketch.", len(batch))
+                self.failed += len(batch)
+            else:
+                self.applied += len(batch)
+
+    def _persist(self):
+        self.cms.flush()
+        if self.save_path is not None:
+            self.cms.save(self.save_path)
+
+    async def stop(self):
+        """
+        Shuts the server down gracefully, see the class documentation
+        """
+        self._server.close()
+        for writer in list(self._connections.values()):
+            writer.close()
+        if self._connections:
+            handlers = asyncio.gather(*self._connections, return_exceptions=True)
+            await asyncio.wait([handlers, self._batcher], return_when=asyncio.FIRST_COMPLETED)
+            if not handlers.done():
+                # The batcher stopped, so nothing drains the queue anymore
+                for task in list(self._connections):
+                    task.cancel()
+                await handlers
+        await self._server.wait_closed()
+        if not self._batcher.done():
+            # Keys queued so far come before the end marker
+            marker = asyncio.ensure_future(self._queue.put(None))
+            await asyncio.wait([marker, self._batcher], return_when=asyncio.FIRST_COMPLETED)
+            if not marker.done():
+                marker.cancel()
+        await asyncio.wait([self._batcher])
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._persist)
+        finally:
+            self._executor.shutdown()
+        if not self._batcher.cancelled():
+            # Raises an unexpected error of the batcher, once the sketch is saved
+            self._batcher.result()
+
+
+def serve(cms, **kwargs):
+    """
+    Runs an IngestServer until SIGINT or SIGTERM, then shuts it down
+    gracefully. Keyword arguments are passed to IngestServer.
+    """
+    async def main():
+        server = IngestServer(cms, **kwargs)
+        address = await server.start()
+        print("Ingesting keys on {}...".format(address))
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(sig, stopping.set)
+        await stopping.wait()
+        print("Shutting down after {:d} keys...".format(server.received))
+        await server.stop()
+        return server
+
+    return asyncio.run(main())
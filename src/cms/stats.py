@@ -0,0 +1,94 @@
+"""
+Load statistics of the counter matrix of a count-min sketch.
+
+LoadStats summarizes each row of a (d, w) counter matrix by its total mass,
+its largest counter, its number of non-empty buckets and a histogram of the
+counters on a log2 scale. These summaries can be computed by a full scan of
+the matrix, or kept up to date incrementally from the old and new values of
+the cells touched by each update, so that polling them costs O(d) rather
+than O(d w).
+"""
+import time
+import numpy as np
+
+# Histogram bin 0 holds empty buckets, bin b > 0 the counters in [2^(b-1), 2^b)
+_N_BINS = 65
+
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+def _log2_bins(values):
+    return np.frexp(np.asarray(values, dtype=np.float64))[1]
+
+
+class LoadStats:
+    def __init__(self, count):
+        d, w = count.shape
+        self.w = w
+        self.mass = count.sum(axis=1, dtype=np.int64)
+        self.max = count.max(axis=1).astype(np.int64)
+        self.nonzero = np.count_nonzero(count, axis=1)
+        self.histogram = np.zeros((d, _N_BINS), dtype=np.int64)
+        for row in range(d):
+            self.histogram[row] = np.bincount(_log2_bins(count[row]), minlength=_N_BINS)
+        self.updates = 0
+        self.queries = 0
+        self.first_update = None
+        self.last_update = None
+
+    def record(self, rows, old, new, single=False):
+        """
+        Accounts for the cells of the given rows whose counters changed from
+        old to new (one entry per cell). single=True means that there is one
+        cell in each row, in order, as in the update of a single key.
+        """
+        old = np.asarray(old, dtype=np.int64)
+        new = np.asarray(new, dtype=np.int64)
+        if single:
+            # Rows are distinct: plain fancy indexing suffices
+            self.mass += new - old
+            np.maximum(self.max, new, out=self.max)
+            self.nonzero += (old == 0) & (new != 0)
+            self.histogram[rows, _log2_bins(old)] -= 1
+            self.histogram[rows, _log2_bins(new)] += 1
+            return
+        np.add.at(self.mass, rows, new - old)
+        np.maximum.at(self.max, rows, new)
+        np.add.at(self.nonzero, rows, (old == 0) & (new != 0))
+        np.add.at(self.histogram, (rows, _log2_bins(old)), -1)
+        np.add.at(self.histogram, (rows, _log2_bins(new)), 1)
+
+    def record_updates(self, n):
+        now = time.perf_counter()
+        if self.first_update is None:
+            self.first_update = now
+        self.last_update = now
+        self.updates += n
+
+    def quantiles(self, probs=QUANTILES):
+        """
+        Returns, for each probability, the per-row quantiles of the counters,
+        rounded up to the upper edge of their log2 histogram bin
+        """
+        cdf = np.cumsum(self.histogram, axis=1) / self.w
+        upper_edges = np.concatenate([[0], 2**np.arange(1, _N_BINS, dtype=np.float64) - 1])
+        return {p: upper_edges[np.argmax(cdf >= p, axis=1)] for p in probs}
+
+    def summary(self):
+        occupancy = self.nonzero / self.w
+        elapsed = None
+        throughput = None
+        if self.first_update is not None:
+            elapsed = self.last_update - self.first_update
+            if elapsed > 0:
+                throughput = self.updates / elapsed
+        return {"mass": self.mass.copy(),
+                "max": self.max.copy(),
+                "empty_fraction": 1.0 - occupancy,
+                "quantiles": self.quantiles(),
+                # Probability that an unseen key hits a non-empty bucket in every row
+                "collision_rate": float(np.prod(occupancy)),
+                "updates": self.updates,
+                "queries": self.queries,
+                "elapsed": elapsed,
+                "updates_per_second": throughput}
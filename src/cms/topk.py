@@ -0,0 +1,65 @@
+"""
+Bounded tracker of the most frequent keys in a sketched stream.
+"""
+import heapq
+
+
+class TopK:
+    """
+    Keeps the k keys with the largest count estimates offered so far.
+
+    This is the heap of the CMS-based heavy-hitters algorithm of Cormode and
+    Muthukrishnan: after each update the sketch offers the key with its new
+    estimate, and the key replaces the smallest tracked one if its estimate
+    is larger. Estimates never decrease, so stale heap entries are skipped
+    lazily instead of being removed.
+    """
+    def __init__(self, k):
+        assert k > 0
+        self.k = k
+        self.estimates = {}
+        self._heap = []
+        self._pushed = 0
+
+    def __len__(self):
+        return len(self.estimates)
+
+    def __contains__(self, x):
+        return x in self.estimates
+
+    def items(self):
+        return self.estimates.items()
+
+    def _push(self, x, estimate):
+        self.estimates[x] = estimate
+        # The counter breaks ties, so that keys are never compared
+        heapq.heappush(self._heap, (estimate, self._pushed, x))
+        self._pushed += 1
+        if len(self._heap) > 4 * self.k + 16:
+            self._heap = [(e, i, y) for i, (y, e) in enumerate(self.estimates.items())]
+            heapq.heapify(self._heap)
+
+    def _peek(self):
+        while True:
+            estimate, _, x = self._heap[0]
+            if self.estimates.get(x) == estimate:
+                return x, estimate
+            heapq.heappop(self._heap)
+
+    def offer(self, x, estimate):
+        """
+        Records the current estimate of key x
+        """
+        estimate = int(estimate)
+        if x in self.estimates:
+            if estimate > self.estimates[x]:
+                self._push(x, estimate)
+            return
+        if len(self.estimates) < self.k:
+            self._push(x, estimate)
+            return
+        smallest, smallest_estimate = self._peek()
+        if estimate > smallest_estimate:
+            heapq.heappop(self._heap)
+            del self.estimates[smallest]
+            self._push(x, estimate)
@@ -4,11 +4,26 @@ from collections import defaultdict
 import pdb
 
 def sum_dict(x, y):
+    if hasattr(x, "merge"):
+        # Exact counters of cms.counters know how to combine themselves
+        return x.merge(y)
     z = x
     for k in y.keys():
         x[k] += y[k]
     return z
 
+def count_keys(stream, n, keys, skip=0):
+    """
+    Counts exactly how many times each of the given keys appears among the
+    next n samples of the stream, ignoring the first skip of them
+    """
+    counts = dict.fromkeys(keys, 0)
+    for i in range(n):
+        x = stream.sample()
+        if (i >= skip) and (x in counts):
+            counts[x] += 1
+    return counts
+
 def dictToList(d):
     reg_list = [[x] * d[x] for x in d.keys()]
     flat_list = [item for sublist in reg_list for item in sublist]
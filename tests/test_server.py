@@ -0,0 +1,144 @@
+import asyncio
+import socket
+import struct
+import threading
+
+import numpy as np
+import pytest
+
+from cms.cms import CMS
+from cms.server import IngestServer
+
+
+async def wait_until(condition, timeout=5.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        assert loop.time() < deadline, "Timed out"
+        await asyncio.sleep(0.01)
+
+
+def test_newline_framing(tmp_path):
+    keys = [str(i % 37) for i in range(2000)] + ["x", "y"]
+    save_path = str(tmp_path / "sketch.cms")
+
+    async def main():
+        cms = CMS(3, 200)
+        server = IngestServer(cms, batch_size=50, flush_interval=0.05, save_path=save_path)
+        host, port = (await server.start())[:2]
+        reader, writer = await asyncio.open_connection(host, port)
+        # Blank lines are ignored and \r\n terminators are accepted
+        writer.write(("\n".join(keys[:-1]) + "\n\n" + keys[-1] + "\r\n").encode())
+        await writer.drain()
+        await wait_until(lambda: server.applied == len(keys))
+        # The last line, without terminator, is read when the client leaves
+        writer.write(b"z")
+        writer.close()
+        await wait_until(lambda: server.received == len(keys) + 1)
+        await server.stop()
+        return server
+
+    server = asyncio.run(main())
+    assert (server.applied, server.failed, server.rejected) == (len(keys) + 1, 0, 0)
+    expected = CMS(3, 200)
+    expected.update_many(keys + ["z"])
+    assert np.array_equal(server.cms.count, expected.count)
+    saved = CMS.load(save_path)
+    assert np.array_equal(saved.count, expected.count)
+    assert saved.true_count == expected.true_count
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="Unix sockets are not available")
+def test_length_framing(tmp_path):
+    path = str(tmp_path / "sock")
+    keys = ["a", "bb", "ü", "a\nb", ""]
+
+    async def main():
+        cms = CMS(3, 200)
+        server = IngestServer(cms, path=path, framing="length", batch_size=100, flush_interval=10,
+                              max_key_size=8)
+        await server.start()
+        reader, writer = await asyncio.open_unix_connection(path)
+        for frame in [x.encode("utf-8") for x in keys] + [b"x" * 9, b"\xff"]:
+            writer.write(struct.pack("!I", len(frame)) + frame)
+        writer.close()
+        await wait_until(lambda: server.received + server.rejected == len(keys) + 2)
+        # The batch is not full and its interval has not expired: stop applies it
+        assert server.applied == 0
+        await server.stop()
+        return server
+
+    server = asyncio.run(main())
+    assert (server.received, server.applied, server.rejected) == (len(keys), len(keys), 2)
+    assert dict(server.cms.true_count.items()) == {x: 1 for x in keys}
+
+
+def test_decode():
+    async def main():
+        cms = CMS(3, 200)
+        server = IngestServer(cms, decode=int)
+        host, port = (await server.start())[:2]
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(b"1\n2\nnot a number\n2\n")
+        writer.close()
+        await wait_until(lambda: server.received + server.rejected == 4)
+        await server.stop()
+        return server
+
+    server = asyncio.run(main())
+    assert server.rejected == 1
+    assert dict(server.cms.true_count.items()) == {1: 1, 2: 2}
+
+
+def test_backpressure():
+    n_keys, batch_size, max_pending = 1000, 10, 20
+
+    async def main():
+        cms = CMS(3, 200)
+        release = threading.Event()
+        update_many = cms.update_many
+
+        def slow_update_many(keys):
+            release.wait()
+            return update_many(keys)
+
+        cms.update_many = slow_update_many
+        server = IngestServer(cms, batch_size=batch_size, flush_interval=0.01, max_pending=max_pending)
+        host, port = (await server.start())[:2]
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write("".join("{:d}\n".format(i) for i in range(n_keys)).encode())
+        await asyncio.sleep(0.3)
+        # One batch is being applied and the queue is full: reading stopped
+        assert server.received <= batch_size + max_pending
+        release.set()
+        await writer.drain()
+        await wait_until(lambda: server.applied == n_keys)
+        writer.close()
+        await server.stop()
+        return server
+
+    server = asyncio.run(main())
+    assert (server.received, server.failed) == (n_keys, 0)
+    assert server.cms.estimate_count("7") >= 1
+
+
+def test_stop_survives_failed_batches():
+    async def main():
+        cms = CMS(3, 200, dtype="uint16")
+        server = IngestServer(cms, batch_size=1, flush_interval=0.01)
+        host, port = (await server.start())[:2]
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(b"a\n")
+        await wait_until(lambda: server.applied == 1)
+        # Counters that overflow uint16 reject the batch, not the server
+        cms.update_many(["b"], [65535])
+        writer.write(b"b\nc\n")
+        await wait_until(lambda: server.applied + server.failed == 3)
+        # stop() also closes the connections that are still open
+        await server.stop()
+        return server
+
+    server = asyncio.run(main())
+    assert (server.applied, server.failed) == (2, 1)
+    assert server.cms.estimate_count("b") == 65535
+    assert server.cms.true_count["b"] == 65535